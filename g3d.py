@@ -1,5 +1,7 @@
 
-import struct, os, sys, time, numpy, math, traceback, ctypes
+import struct, os, sys, time, numpy, math, traceback, ctypes, hashlib, json
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 def fmt_bytes(b):
     for m in ["B","KB","MB","GB"]:
@@ -61,6 +63,266 @@ class Bounds:
         z = -self.bounds[2]-(d/2.)
         return (x,y,z)
 
+def _import_image():
+    try:
+        import Image
+    except ImportError:
+        from PIL import Image
+    return Image
+
+def _image_bytes(image,mode):
+    # bottom row first, as glTexImage2D expects
+    if hasattr(image,"tobytes"):
+        return image.tobytes("raw",mode,0,-1)
+    return image.tostring("raw",mode,0,-1)
+
+class Texture:
+    """an image decoded (off the GL thread) into a mip chain ready for upload"""
+    def __init__(self,filename,mipmaps=True):
+        Image = _import_image()
+        image = Image.open(filename)
+        image.load()
+        self.filename = filename
+        self.opaque = image.mode not in ("RGBA","LA") and "transparency" not in image.info
+        self.mode = "RGB" if self.opaque else "RGBA"
+        image = image.convert(self.mode)
+        self.w, self.h = w, h = image.size
+        self.levels = [_image_bytes(image,self.mode)]
+        self.digest = hashlib.sha1("%s %dx%d "%(self.mode,w,h)+self.levels[0]).hexdigest()
+        while mipmaps and (w > 1 or h > 1):
+            w, h = max(w//2,1), max(h//2,1)
+            image = image.resize((w,h),Image.ANTIALIAS)
+            self.levels.append(_image_bytes(image,self.mode))
+            
+def decode_textures(filenames,threads=None,mipmaps=True):
+    """decodes images on a pool of threads, yielding (filename,Texture) as each completes;
+    if an image cannot be decoded, the exception is yielded in place of the Texture"""
+    def decode(filename):
+        try:
+            return (filename,Texture(filename,mipmaps))
+        except Exception as e:
+            return (filename,e)
+    pool = ThreadPool(threads or cpu_count())
+    try:
+        for decoded in pool.imap_unordered(decode,filenames):
+            yield decoded
+    finally:
+        pool.terminate()
+        
+def upload_texture(GL,name,texture):
+    mode = GL.GL_RGB if texture.opaque else GL.GL_RGBA
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT,1)
+    GL.glBindTexture(GL.GL_TEXTURE_2D,name)
+    GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_WRAP_S,GL.GL_CLAMP)
+    GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_WRAP_T,GL.GL_CLAMP)
+    GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_MAG_FILTER,GL.GL_LINEAR)
+    GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_MIN_FILTER,
+        GL.GL_LINEAR_MIPMAP_LINEAR if len(texture.levels) > 1 else GL.GL_LINEAR)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_MAX_LEVEL,len(texture.levels)-1)
+    w, h = texture.w, texture.h
+    for level,pixels in enumerate(texture.levels):
+        GL.glTexImage2D(GL.GL_TEXTURE_2D,level,mode,w,h,0,mode,GL.GL_UNSIGNED_BYTE,pixels)
+        w, h = max(w//2,1), max(h//2,1)
+        
+def load_textures_gl(GL,textures,opaque_textures,threads=None,atlas=None,filenames=None,canonical=None):
+    """decodes the textures ({filename: name}) off-thread and uploads each distinct image once;
+    duplicates are re-pointed in textures and returned as {name: canonical name}.
+    If an Atlas is given, the decoded textures are handed to it instead of being uploaded.
+    To load textures incrementally, pass just the new filenames along with the same
+    canonical ({digest: name}) dict each time"""
+    canonical, aliases = {} if canonical is None else canonical, {}
+    for filename,texture in decode_textures(textures.keys() if filenames is None else filenames,threads):
+        name = textures[filename]
+        if isinstance(texture,Exception):
+            print "Could not load texture",filename,"->",name
+            print texture
+            continue
+        if texture.digest in canonical:
+            aliases[name] = textures[filename] = canonical[texture.digest]
+            continue
+        canonical[texture.digest] = name
+        if texture.opaque:
+            opaque_textures.add(name)
+        if atlas is not None:
+            atlas.add(name,texture)
+        else:
+            upload_texture(GL,name,texture)
+    if aliases:
+        print "%d distinct textures, %d duplicates shared"%(len(canonical),len(aliases))
+    return aliases
+    
+def shelf_pack(sizes,width,height=None):
+    """places (w,h) rectangles on shelves, tallest first, starting a new page when one
+    is height high; returns ([(page,x,y)] in the order given, [(w,h) used on each page])"""
+    placed, used = [None]*len(sizes), []
+    x = y = shelf = 0
+    for i in sorted(xrange(len(sizes)),key=lambda i: (-sizes[i][1],-sizes[i][0])):
+        w, h = sizes[i]
+        if x+w > width:
+            x, y, shelf = 0, y+shelf, 0
+        if (not used) or ((height is not None) and (y+h > height)):
+            used.append((0,0))
+            x = y = shelf = 0
+        placed[i] = (len(used)-1,x,y)
+        x, shelf = x+w, max(shelf,h)
+        used[-1] = (max(used[-1][0],x),max(used[-1][1],y+h))
+    return placed, used
+
+def tiles(mesh):
+    """whether a mesh has texcoords outside 0-1, so needs its texture to repeat"""
+    return (mesh.txCoords is not None) and ((mesh.txCoords < 0.).any() or (mesh.txCoords > 1.).any())
+
+class Atlas:
+    """packs decoded textures into a few large pages so that meshes with different textures
+    can share one bind; textures that need to wrap, or are too big, are uploaded as they are"""
+    def __init__(self,page_size=2048,padding=8):
+        self.page_size, self.padding = page_size, padding
+        self.textures = {}
+        self.pages = []
+        self.used = []
+        self.placement = {}
+        self.packed_texels = 0
+        self.standalone = set() # packed textures that a later mesh tiled, so were uploaded too
+    def add(self,name,texture):
+        self.textures[name] = texture
+    def _pack(self,names):
+        # cells are aligned to the padding so that every mip level
+        # keeps at least one texel of gutter around each texture
+        pad, size = self.padding, self.page_size
+        align = lambda v: (v+pad-1)//pad*pad
+        sizes = [(align(self.textures[name].w+2*pad),align(self.textures[name].h+2*pad)) for name in names]
+        placed, self.used = shelf_pack(sizes,size,size)
+        self.pages = [numpy.zeros((size,size,4),dtype=numpy.uint8) for used in self.used]
+        for name,(w,h),(page,x,y) in zip(names,sizes,placed):
+            texture = self.textures[name]
+            pixels = numpy.frombuffer(texture.levels[0],dtype=numpy.uint8).reshape(texture.h,texture.w,-1)
+            if texture.opaque:
+                pixels = numpy.dstack((pixels,numpy.full((texture.h,texture.w),255,dtype=numpy.uint8)))
+            # the gutter repeats the edge texels, which is what GL_CLAMP looks like
+            self.pages[page][y:y+h,x:x+w] = numpy.pad(pixels,
+                ((pad,h-texture.h-pad),(pad,w-texture.w-pad),(0,0)),"edge")
+            self.placement[name] = (page,x+pad,y+pad,texture.w,texture.h)
+            self.packed_texels += texture.w*texture.h
+        # pages needn't be bigger than the power of two that holds what was packed
+        pow2 = lambda v: 1<<int(math.ceil(math.log(v,2)))
+        self.pages = [page[:pow2(h),:pow2(w)] for page,(w,h) in zip(self.pages,self.used)]
+    def upload_gl(self,GL,meshes,assign_object,opaque_textures):
+        tiled = set(mesh.texture for mesh in meshes if tiles(mesh))
+        limit = self.page_size-2*self.padding
+        packable = []
+        for name,texture in self.textures.iteritems():
+            if (name in tiled) or (texture.w > limit) or (texture.h > limit):
+                upload_texture(GL,name,texture)
+            else:
+                packable.append(name)
+        self._pack(packable)
+        self.names = names = []
+        for i,page in enumerate(self.pages):
+            name = assign_object()
+            names.append(name)
+            if all(self.textures[t].opaque for t,p in self.placement.iteritems() if p[0] == i):
+                opaque_textures.add(name)
+            GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT,1)
+            GL.glBindTexture(GL.GL_TEXTURE_2D,name)
+            GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_WRAP_S,GL.GL_CLAMP_TO_EDGE)
+            GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_WRAP_T,GL.GL_CLAMP_TO_EDGE)
+            GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_MAG_FILTER,GL.GL_LINEAR)
+            GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_MIN_FILTER,GL.GL_LINEAR_MIPMAP_LINEAR)
+            levels = int(math.log(self.padding,2))+1
+            GL.glTexParameteri(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_MAX_LEVEL,levels-1)
+            for level in xrange(levels):
+                h, w = page.shape[:2]
+                GL.glTexImage2D(GL.GL_TEXTURE_2D,level,GL.GL_RGBA,w,h,0,GL.GL_RGBA,GL.GL_UNSIGNED_BYTE,page.tobytes())
+                page = page.reshape(h//2,2,w//2,2,4).astype(numpy.uint16).sum(axis=(1,3))
+                page = ((page+2)//4).astype(numpy.uint8)
+        self.remap(GL,meshes)
+        return len(self.placement), len(self.textures)-len(self.placement)
+    def remap(self,GL,meshes):
+        """points meshes with packed textures at their pages; a packed texture that a mesh
+        tiles is uploaded on its own, the first time, for that mesh to use instead"""
+        for mesh in meshes:
+            if mesh.texture in self.placement:
+                if tiles(mesh):
+                    if mesh.texture not in self.standalone:
+                        upload_texture(GL,mesh.texture,self.textures[mesh.texture])
+                        self.standalone.add(mesh.texture)
+                    continue
+                page,x,y,w,h = self.placement[mesh.texture]
+                mesh.packed_texture, mesh.texture = mesh.texture, self.names[page]
+                page_h, page_w = self.pages[page].shape[:2]
+                mesh.txCoords = (mesh.txCoords*(w,h)+(x,y))/numpy.array((page_w,page_h),dtype=numpy.float64)
+                mesh.txCoords = mesh.txCoords.astype(numpy.float32)
+    def efficiency(self):
+        if not self.pages:
+            return 0.
+        return float(self.packed_texels)/sum(page.shape[0]*page.shape[1] for page in self.pages)
+    
+def alias_textures(models,aliases):
+    for model in models:
+        for mesh in model.meshes:
+            if mesh.texture in aliases:
+                mesh.texture = aliases[mesh.texture]
+            if getattr(mesh,"bumpmap",None) in aliases:
+                mesh.bumpmap = aliases[mesh.bumpmap]
+
+def texture_path(filename,texture):
+    """where a texture named in a model is, relative to that model"""
+    while texture.startswith("\\") or texture.startswith("/"):
+        texture = texture[1:]
+    return os.path.join(os.path.split(filename)[0],texture)
+    
+def texture_paths(filename):
+    """the textures a model references, read from its mesh headers without loading it"""
+    textures = []
+    f = BinaryStream(filename)
+    try:
+        if f.read(3) != "G3D":
+            raise Exception("%s is not a G3D file"%filename)
+        ver = f.uint8()
+        if ver == 3:
+            for mesh in xrange(f.uint32()):
+                frameCount, normalCount, texCoordCount, colorCount, \
+                    vertexCount, indexCount, properties = [f.uint32() for i in xrange(7)]
+                texture = f.text64()
+                if 0 == (properties & 1):
+                    textures.append(texture)
+                else:
+                    texCoordCount = 0
+                f.f.seek(vertexCount*(12*frameCount+12*normalCount+8*texCoordCount)+ \
+                    16*colorCount+4*indexCount,1)
+        elif ver == 4:
+            meshCount = f.uint16()
+            f.uint8()
+            for mesh in xrange(meshCount):
+                f.read(64)
+                frameCount, vertexCount, indexCount = f.uint32(), f.uint32(), f.uint32()
+                f.read(8*4)
+                properties, flags = f.uint32(), f.uint32()
+                for t in xrange(5):
+                    if ((1 << t) & flags) != 0:
+                        textures.append(f.text64())
+                f.f.seek(vertexCount*(24*frameCount+(8 if flags else 0))+4*indexCount,1)
+        else:
+            raise Exception("%s unsupported G3D version: %s"%(filename,ver))
+    finally:
+        f.f.close()
+    return [texture_path(filename,texture) for texture in textures]
+
+def cache_key(filename,settings):
+    """hashes the model, the textures it references and the settings it is processed with,
+    so outputs are remade when any of them change but not when mtimes do"""
+    key = hashlib.sha1(json.dumps(settings,sort_keys=True))
+    key.update(open(filename,"rb").read())
+    try:
+        textures = texture_paths(filename)
+    except Exception,e:
+        print "### could not read textures of",filename,e
+        textures = []
+    for texture in textures:
+        key.update(os.path.relpath(texture,os.path.dirname(filename)).replace("\\","/"))
+        key.update(open(texture,"rb").read() if os.path.isfile(texture) else "(missing)")
+    return key.hexdigest()
+
 def repack(array):
     h,w = array.shape
     new = numpy.zeros(w*h,dtype=array.dtype)
@@ -73,6 +335,7 @@ class Mesh(object):
         self.g3d = g3d
         self.txCoords = None
         self.texture = None
+        self.packed_texture = None # what texture was, before it was pointed at an atlas page
         self.bounds = []
         self.in_vertices = 0
         self.in_indices = 0
@@ -200,17 +463,27 @@ class Mesh(object):
             GL.glEnd()
         vertices, normals, textures = self.interop(now)
         if not self.g3d.mgr.render_normals: normals = None
-        GL.glBindTexture(GL.GL_TEXTURE_2D,self.texture if textures is not None else 0)
-        (GL.glDisable if self.twoSided else GL.glEnable)(GL.GL_CULL_FACE)
-        if self.customColor:
-            GL.glColor(1,0,0,1)
-            GL.glTexEnvi(GL.GL_TEXTURE_ENV,GL.GL_TEXTURE_ENV_MODE,GL.GL_DECAL)
-        else:
-            GL.glColor(1,1,1,1)
-            GL.glTexEnvi(GL.GL_TEXTURE_ENV,GL.GL_TEXTURE_ENV_MODE,GL.GL_BLEND)
+        state = self.gl_state()
+        if state != self.g3d.mgr.gl_state:
+            # consecutive meshes in the same state (e.g. sharing an atlas page) skip the rebind
+            self.g3d.mgr.gl_state = state
+            GL.glBindTexture(GL.GL_TEXTURE_2D,state[0])
+            (GL.glDisable if self.twoSided else GL.glEnable)(GL.GL_CULL_FACE)
+            if self.customColor:
+                GL.glColor(1,0,0,1)
+                GL.glTexEnvi(GL.GL_TEXTURE_ENV,GL.GL_TEXTURE_ENV_MODE,GL.GL_DECAL)
+            else:
+                GL.glColor(1,1,1,1)
+                GL.glTexEnvi(GL.GL_TEXTURE_ENV,GL.GL_TEXTURE_ENV_MODE,GL.GL_BLEND)
         draw()
-        GL.glDisable(GL.GL_CULL_FACE)
-        GL.glBindTexture(GL.GL_TEXTURE_2D,0)
+    def gl_state(self):
+        return (self.texture if self.txCoords is not None else 0,self.twoSided,self.customColor)
+    def blended(self):
+        """whether its texture's alpha blends it with what is drawn behind it; an atlas page
+        may mix opaque and transparent textures, so it's the texture that was packed that counts"""
+        if (self.txCoords is None) or (self.texture is None) or self.customColor:
+            return False
+        return (self.packed_texture or self.texture) not in self.g3d.mgr.opaque_textures
         
 class Mesh3(Mesh):
     def __init__(self,g3d,f):
@@ -295,35 +568,50 @@ class G3D:
         s = 2./bounds.diag()
         self.scaling = (x,y,z,s)
         if self.meshes:
-            self.frame_count = len(self.meshes[0].vertices)
-            for mesh in self.meshes[1:]:
-                assert len(mesh.vertices) == self.frame_count
+            # parts that don't move may have been split off into meshes of a single frame
+            self.frame_count = max(len(mesh.vertices) for mesh in self.meshes)
+            for mesh in self.meshes:
+                assert len(mesh.vertices) in (1,self.frame_count)
         else:
             self.frame_count = 0
     def assign_texture(self,texture):
-        while texture.startswith("\\") or texture.startswith("/"):
-            texture = texture[1:]
-        texture = os.path.join(os.path.split(self.filename)[0],texture)
-        return self.mgr.assign_texture(texture)
+        return self.mgr.assign_texture(texture_path(self.filename,texture))
     def init_gl(self):
         for mesh in self.meshes:
             mesh.init_gl()
+        self.draw_order = self.meshes
+        if self.mgr.atlas:
+            # runs of opaque meshes are sorted by state (stably, so meshes that share a state keep
+            # their order); blended meshes stay where they are, as what they cover must be drawn first
+            self.draw_order, run = [], []
+            for mesh in self.meshes + [None]:
+                if (mesh is not None) and not mesh.blended():
+                    run.append(mesh)
+                    continue
+                self.draw_order += sorted(run,key=lambda mesh: mesh.gl_state())
+                run = []
+                if mesh is not None:
+                    self.draw_order.append(mesh)
     def draw_gl(self,now):
         GL.glBlendFunc(GL.GL_SRC_ALPHA,GL.GL_ONE_MINUS_SRC_ALPHA)
         GL.glPushMatrix()
         GL.glInitNames(1)
+        self.mgr.gl_state = None
         try:
             GL.glScale(self.scaling[3],self.scaling[3],self.scaling[3])
             GL.glTranslate(self.scaling[0],self.scaling[1],self.scaling[2])
-            for mesh in self.meshes:
+            for mesh in self.draw_order:
                 GL.glPushName(self.mgr.assign_mesh(mesh))
                 mesh.draw_gl(now)
                 GL.glPopName()
         finally:
             GL.glPopMatrix()
+            GL.glDisable(GL.GL_CULL_FACE)
+            GL.glBindTexture(GL.GL_TEXTURE_2D,0)
+            self.mgr.gl_state = None
         
 class Manager:
-    def __init__(self,base_folder=os.getcwd(),use_shaders=False):
+    def __init__(self,base_folder=os.getcwd(),use_shaders=False,atlas=False):
         self.base_folder = base_folder
         self.meshes = {}
         self.mesh_reverse = {}
@@ -331,12 +619,33 @@ class Manager:
         self.models = {}
         self.opaque_textures = set()
         self._seq = 0
+        self._mesh_seq = 0 # mesh names are never reused, so one can't resolve to a later mesh
         self.use_shaders = use_shaders
+        self.atlas = atlas
+        self.gl_state = None
+        self._inited = set() # models whose textures are loaded
+        self._loaded = set() # texture filenames already decoded
+        self._digests = {}
+        self._atlases = []
     def load_model(self,filename):
         filename = os.path.relpath(filename,self.base_folder)
         if filename not in self.models:
             self.models[filename] = G3D(self,filename)
         return self.models[filename]
+    def unload_model(self,filename):
+        """forgets a model and frees its buffers, but keeps its textures for the models that follow"""
+        filename = os.path.relpath(filename,self.base_folder)
+        model = self.models.pop(filename)
+        self._inited.discard(filename)
+        self.gl_state = None
+        for mesh in model.meshes:
+            if mesh in self.meshes:
+                del self.mesh_reverse[self.meshes.pop(mesh)]
+            if mesh.using_shaders is not None:
+                indices,verts,norms,txCoords = mesh.using_shaders
+                buffers = [indices]+verts+norms+([txCoords] if txCoords is not None else [])
+                GL.glDeleteBuffers(len(buffers),buffers)
+                mesh.using_shaders = None
     def assign_texture(self,texture):
         if texture not in self.textures:
             v = self.assign_object()
@@ -354,7 +663,8 @@ class Manager:
         return self._seq
     def assign_mesh(self,mesh):
         if mesh not in self.meshes:
-            v = len(self.meshes)+1
+            self._mesh_seq += 1
+            v = self._mesh_seq
             self.meshes[mesh] = v
             self.mesh_reverse[v] = mesh
         return self.meshes[mesh]
@@ -365,31 +675,27 @@ class Manager:
         global GL
         GL = __import__('OpenGL',globals(),locals()).GL
         self.render_normals = True
-        self._load_textures_gl()
-        for model in self.models.values():
+        # only models loaded since the last call need initialising,
+        # so one Manager (and context) can be reused for a whole batch
+        models = [model for filename,model in self.models.iteritems() if filename not in self._inited]
+        self._inited.update(self.models.keys())
+        self._load_textures_gl(models)
+        for model in models:
             model.init_gl()
         GL.glMaterialfv(GL.GL_FRONT,GL.GL_AMBIENT_AND_DIFFUSE,(1.,0.,0.,1.))
-    def _load_textures_gl(self):
-        import Image
-        for filename,texture in self.textures.iteritems():
-            try:
-                image = Image.open(filename)
-                w, h = image.size
-                try:
-                    img = image.tostring("raw","RGBA",0,-1)
-                    mode = GL.GL_RGBA
-                except Exception as e:
-                    img = image.tostring("raw","RGB",0,-1)
-                    mode = GL.GL_RGB
-                    self.opaque_textures.add(texture)
-                image = img
-                GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT,1)
-                GL.glBindTexture(GL.GL_TEXTURE_2D,texture)
-                GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_WRAP_S,GL.GL_CLAMP)
-                GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_WRAP_T,GL.GL_CLAMP)
-                GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_MAG_FILTER,GL.GL_LINEAR)
-                GL.glTexParameterf(GL.GL_TEXTURE_2D,GL.GL_TEXTURE_MIN_FILTER,GL.GL_LINEAR)
-                GL.glTexImage2D(GL.GL_TEXTURE_2D,0,mode,w,h,0,mode,GL.GL_UNSIGNED_BYTE,image)
-            except Exception,e:
-                print "Could not load texture",filename,"->",texture
-                print e
+    def _load_textures_gl(self,models):
+        filenames = [filename for filename in self.textures if filename not in self._loaded]
+        self._loaded.update(filenames)
+        atlas = Atlas() if self.atlas else None
+        aliases = load_textures_gl(GL,self.textures,self.opaque_textures,atlas=atlas,
+            filenames=filenames,canonical=self._digests)
+        alias_textures(models,aliases)
+        meshes = [mesh for model in models for mesh in model.meshes]
+        for previous in self._atlases:
+            previous.remap(GL,meshes)
+        if atlas is not None:
+            self._atlases.append(atlas)
+            packed, unpacked = atlas.upload_gl(GL,meshes,self.assign_object,self.opaque_textures)
+            print "Atlas: %d textures packed into %d pages (%s) %1.1f%% used, %d left unpacked"% \
+                (packed,len(atlas.pages),", ".join("%dx%d"%page.shape[1::-1] for page in atlas.pages),
+                atlas.efficiency()*100.,unpacked)
@@ -4,7 +4,13 @@
 # this tool coalesces them.  This increases the possibilities for G3DHack optimisations
 # and reduces the number of draw calls needed to draw the model in-game.
 
-import struct, sys, os, getopt, math
+import struct, sys, os, re, getopt, math, copy, heapq, zlib, subprocess, cStringIO, json, traceback, errno
+import numpy
+import img_header
+from g3d import texture_path, cache_key
+
+max_indices = 0xffff # the most indices a joined mesh may have
+subtexels = 16 # texcoords are quantized to this fraction of a texel
 
 class Reader:
     def __init__(self,bytes):
@@ -16,56 +22,688 @@ class Reader:
     def readF32(self,count=1): return self._read("<"+"f"*count,4,count)
     def readS64(self): return ("".join(self._read("c"*64,1,64))).split('\x00')[0]
     def read(self,fmt): return self._read(fmt,1,struct.calcsize(fmt))
+    def array(self,dtype,count):
+        # a read-only view of the bytes, not a copy
+        dtype = numpy.dtype(dtype)
+        if self.ofs+dtype.itemsize*count > len(self.bytes):
+            raise Exception("truncated")
+        ret = numpy.frombuffer(self.bytes,dtype,count,self.ofs)
+        self.ofs += dtype.itemsize*count
+        return ret
     def _read(self,fmt,width,count):
         self.ofs += width*count
         ret = struct.unpack(fmt,self.bytes[self.ofs-(count*width):self.ofs])
         return ret[0] if count == 1 else ret
 
+def cache_misses(indices,cache_size):
+    """how many vertices a FIFO post-transform cache of cache_size entries has to transform"""
+    cache, fifo, misses = set(), [], 0
+    for v in indices:
+        if v not in cache:
+            misses += 1
+            cache.add(v)
+            fifo.append(v)
+            if len(fifo) > cache_size:
+                cache.discard(fifo.pop(0))
+    return misses
+
+def tipsify(indices,vertex_count,cache_size):
+    """reorders triangles for the post-transform vertex cache, after Sander, Nehab and
+    Barczak's Tipsify: fan out from a vertex, then move to the vertex among those just
+    emitted that will still be in the cache, else to a recent one that has triangles left.
+    Each triangle keeps its winding; returns the new indices"""
+    triangles = indices.reshape(-1,3)
+    order = numpy.argsort(indices,kind="mergesort")
+    starts = numpy.searchsorted(indices[order],numpy.arange(vertex_count+1)).tolist()
+    adjacency = (order//3).tolist()
+    tris = triangles.tolist()
+    live = numpy.bincount(indices,minlength=vertex_count).tolist()
+    cache_time = [0]*vertex_count
+    emitted = [False]*len(tris)
+    dead_end = []
+    out = []
+    s, i = cache_size+1, 0
+    f = int(indices[0]) if len(indices) else -1
+    while f >= 0:
+        candidates = []
+        for t in adjacency[starts[f]:starts[f+1]]:
+            if emitted[t]: continue
+            emitted[t] = True
+            for v in tris[t]:
+                out.append(v)
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if s-cache_time[v] > cache_size:
+                    cache_time[v] = s
+                    s += 1
+        # the next fanning vertex
+        f, best = -1, -1
+        for v in candidates:
+            if live[v] > 0:
+                p = s-cache_time[v] if s-cache_time[v]+2*live[v] <= cache_size else 0
+                if p > best:
+                    f, best = v, p
+        while (f < 0) and dead_end:
+            v = dead_end.pop()
+            if live[v] > 0:
+                f = v
+        while (f < 0) and (i < vertex_count):
+            if live[i] > 0:
+                f = i
+            i += 1
+    return numpy.array(out,dtype=numpy.uint32)
+
+def lerp_error(frames,i,j):
+    """the furthest any vertex in frames i+1..j-1 is from linearly interpolating frames i and j;
+    frames is (F,V,n) and j can be F, meaning frame 0 again, as Glest loops back to it"""
+    if j-i < 2:
+        return 0.
+    a = numpy.arange(1,j-i,dtype=numpy.float32)[:,None,None]/(j-i)
+    lerp = frames[i]*(1-a)+frames[j%len(frames)]*a
+    d = lerp-frames[i+1:j]
+    return float(numpy.sqrt((d*d).sum(axis=-1)).max())
+
+def keyframes(frames,tolerance):
+    """the fewest frames, always including frame 0, that linear interpolation (looping back
+    to frame 0) reproduces all the others from to within tolerance, and the error.
+    Each frame is tried as the start of a span, stretched until it no longer fits;
+    the shortest path through those spans is the answer"""
+    frame_count = len(frames)
+    best = [(0,0.,None)]+[None]*frame_count # (keyframes,error,previous)
+    for i in xrange(frame_count):
+        count, error, prev = best[i]
+        if (best[frame_count] is not None) and (count >= best[frame_count][0]):
+            continue # can't beat the fewest found so far
+        j = i+1
+        while j <= frame_count:
+            e = lerp_error(frames,i,j)
+            if e > tolerance:
+                break
+            candidate = (count+1,max(error,e),i)
+            if (best[j] is None) or (candidate[:2] < best[j][:2]):
+                best[j] = candidate
+            j += 1
+    keys, j = [], best[frame_count][2]
+    while j is not None:
+        keys.append(j)
+        j = best[j][2]
+    return keys[::-1], best[frame_count][1]
+
+def resample(frames,count):
+    """count frames evenly spaced over the loop of frames, interpolating linearly"""
+    at = numpy.arange(count)*float(len(frames))/count
+    lo = numpy.floor(at).astype(numpy.int_)
+    a = (at-lo).astype(numpy.float32)[:,None,None]
+    return frames[lo]*(1-a)+frames[(lo+1)%len(frames)]*a
+
+def resample_error(frames,count):
+    """how far playing back resample(frames,count) strays from the original frames"""
+    samples = resample(frames,count)
+    d = resample(samples,len(frames))-frames
+    return float(numpy.sqrt((d*d).sum(axis=-1)).max())
+
+def quadric_cost(Q,P):
+    """x'Qx summed over frames, for quadrics Q (...,F,10) held as their upper triangle
+    and positions P (...,F,3)"""
+    x, y, z = P[...,0], P[...,1], P[...,2]
+    a2, ab, ac, ad, b2, bc, bd, c2, cd, d2 = numpy.rollaxis(Q,-1)
+    return (a2*x*x+b2*y*y+c2*z*z+2*(ab*x*y+ac*x*z+bc*y*z+ad*x+bd*y+cd*z)+d2).sum(axis=-1)
+
+def simplify(vertices,indices,locked,targets):
+    """collapses edges of the triangles indices (T,3) into one of their ends, cheapest first
+    by Garland and Heckbert's quadric error summed over every frame of vertices (F,V,3).
+    Locked vertices are never collapsed, only collapsed into; no collapse may flip a
+    triangle in any frame.  Returns the (indices,error) left once the triangle count
+    reaches each of the descending targets, error being the root of the worst collapse's
+    quadric error per frame"""
+    frame_count = len(vertices)
+    P = vertices.transpose(1,0,2).astype(numpy.float64) # (V,F,3)
+    corners = P[indices] # (T,3,F,3)
+    n = numpy.cross(corners[:,1]-corners[:,0],corners[:,2]-corners[:,0])
+    n /= numpy.maximum(numpy.sqrt((n*n).sum(axis=-1)),1e-12)[...,None]
+    d = -(n*corners[:,0]).sum(axis=-1)
+    a, b, c = n[...,0], n[...,1], n[...,2]
+    planes = numpy.dstack((a*a,a*b,a*c,a*d,b*b,b*c,b*d,c*c,c*d,d*d)) # (T,F,10)
+    Q = numpy.zeros((len(P),frame_count,10))
+    for k in range(3):
+        numpy.add.at(Q,indices[:,k],planes)
+    tris = indices.tolist()
+    vertex_tris = [set() for v in xrange(len(P))]
+    for t,tri in enumerate(tris):
+        for v in tri:
+            vertex_tris[v].add(t)
+    alive = [True]*len(tris)
+    version = [0]*len(P)
+    heap = []
+    def push(pairs):
+        pairs = [(u,v) for u,v in pairs if not locked[u]]
+        if not pairs:
+            return
+        u, v = numpy.array(pairs).T
+        for (u,v),cost in zip(pairs,quadric_cost(Q[u]+Q[v],P[v]).tolist()):
+            heapq.heappush(heap,(cost,u,v,version[u],version[v]))
+    edges = set()
+    for tri in tris:
+        for k in range(3):
+            edges.add((tri[k],tri[k-1]))
+            edges.add((tri[k-1],tri[k]))
+    push(edges)
+    live, error, out = len(tris), 0., []
+    targets = list(targets)
+    while targets:
+        if (live <= targets[0]) or not heap:
+            out.append((numpy.array([tri for t,tri in enumerate(tris) if alive[t]],dtype=numpy.uint32).reshape(-1,3),
+                error))
+            targets.pop(0)
+            continue
+        cost, u, v, vu, vv = heapq.heappop(heap)
+        if (version[u] != vu) or (version[v] != vv) or not vertex_tris[u]:
+            continue # stale
+        moved = [t for t in vertex_tris[u] if v not in tris[t]]
+        if moved:
+            before = numpy.array([tris[t] for t in moved])
+            after = numpy.where(before == u,v,before)
+            def normals(tri):
+                c = P[tri] # (k,3,F,3)
+                return numpy.cross(c[:,1]-c[:,0],c[:,2]-c[:,0])
+            if ((normals(before)*normals(after)).sum(axis=-1) <= 0).any():
+                continue
+        for t in list(vertex_tris[u]):
+            if v in tris[t]:
+                alive[t] = False
+                live -= 1
+                for w in tris[t]:
+                    vertex_tris[w].discard(t)
+            else:
+                tris[t][tris[t].index(u)] = v
+                vertex_tris[v].add(t)
+        vertex_tris[u] = set()
+        Q[v] += Q[u]
+        version[u] += 1
+        version[v] += 1
+        error = max(error,math.sqrt(max(cost,0.)/frame_count))
+        neighbours = set(w for t in vertex_tris[v] for w in tris[t] if w != v)
+        push([(v,w) for w in neighbours]+[(w,v) for w in neighbours])
+    return out
+
+def pack_bins(sizes,capacity,ordered=False):
+    """groups items into bins whose sizes sum to at most capacity (an item bigger than that gets
+    a bin of its own): first fit decreasing or, if ordered, filling one bin at a time so each
+    holds a run of consecutive items.  Returns each bin's item indices, in order"""
+    bins, loads = [], []
+    order = range(len(sizes)) if ordered else sorted(range(len(sizes)),key=lambda i: -sizes[i])
+    for i in order:
+        if ordered:
+            fits = [len(bins)-1] if bins and (loads[-1]+sizes[i] <= capacity) else []
+        else:
+            fits = [b for b,load in enumerate(loads) if load+sizes[i] <= capacity][:1]
+        if not fits:
+            bins.append([])
+            loads.append(0)
+            fits = [len(bins)-1]
+        bins[fits[0]].append(i)
+        loads[fits[0]] += sizes[i]
+    return [sorted(b) for b in bins]
+
+def join_meshes(meshes):
+    """a mesh with the triangles of all of meshes, which have the same state, in order"""
+    if len(meshes) == 1:
+        return meshes[0]
+    mesh = copy.copy(meshes[0])
+    mesh.vertices = numpy.concatenate([m.vertices for m in meshes],axis=1)
+    mesh.normals = numpy.concatenate([m.normals for m in meshes],axis=1)
+    if mesh.textures is not None:
+        mesh.textures = numpy.concatenate([m.textures for m in meshes])
+    mesh.indices = numpy.empty(sum(m.index_count for m in meshes),dtype=numpy.uint32)
+    i = v = 0
+    for m in meshes:
+        numpy.add(m.indices,v,out=mesh.indices[i:i+m.index_count],casting="unsafe")
+        i += m.index_count
+        v += m.vertex_count
+    return mesh
+
+def pow2_step(error):
+    """the biggest power of two whose multiples are all within error of any value"""
+    return 2.**math.floor(math.log(2*error,2))
+
+def in_order(first,second):
+    """whether every triangle that first selects comes before every one that second does,
+    so that drawing them as two meshes, first then second, keeps the order they were drawn in"""
+    return (not first.any()) or (not second.any()) or \
+        (numpy.nonzero(first)[0].max() < numpy.nonzero(second)[0].min())
+
+def snap(values,step):
+    """values (...,n) rounded to multiples of step, and the furthest any point moved; with
+    step a power of two, the low bits of the float32 mantissas are all zero, so they
+    compress far better"""
+    snapped = (numpy.round(values/step)*step).astype(numpy.float32)
+    moved = snapped-values
+    return snapped, float(numpy.sqrt((moved*moved).sum(axis=-1)).max()) if values.size else 0.
+
+def compressed_sizes(data):
+    """the size of data deflated and xz'd (None if there's no xz to run)"""
+    try:
+        xz = subprocess.Popen(["xz","-e","-9","-c"],stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+        xz = len(xz.communicate(data)[0])
+    except OSError:
+        xz = None
+    return len(zlib.compress(data,9)), xz
+
+def rendered_triangles(g3d,frame_count):
+    """every triangle of every mesh as the game draws it over frame_count evenly spaced frames
+    of the animation: corner positions and normals (T,3,F,3), texcoords (T,3,2; NaN if
+    untextured), diffuse texture and whether it's two-sided"""
+    positions, normals, uvs, textures, two_sided = [], [], [], [], []
+    for mesh in g3d.meshes:
+        triangles = mesh.indices[:mesh.index_count//3*3].reshape(-1,3)
+        if not len(triangles):
+            continue
+        vertices, vertex_normals = mesh.vertices, mesh.normals
+        if mesh.frame_count != frame_count:
+            vertices, vertex_normals = resample(vertices,frame_count), resample(vertex_normals,frame_count)
+        # triangles without area in any frame aren't drawn
+        corners = vertices[:,triangles]
+        area = numpy.cross(corners[:,:,1]-corners[:,:,0],corners[:,:,2]-corners[:,:,0])
+        triangles = triangles[(area != 0).any(axis=(0,2))]
+        positions.append(vertices[:,triangles].transpose(1,2,0,3))
+        normals.append(vertex_normals[:,triangles].transpose(1,2,0,3))
+        uvs.append(mesh.textures[triangles] if mesh.textures is not None else \
+            numpy.full((len(triangles),3,2),numpy.nan,dtype=numpy.float32))
+        textures.extend([mesh.texture]*len(triangles))
+        two_sided.append(numpy.full(len(triangles),bool(mesh.twoSided)))
+    if not positions:
+        return (numpy.zeros((0,3,frame_count,3)),)*2+(numpy.zeros((0,3,2)),[],numpy.zeros(0,dtype=bool))
+    return numpy.concatenate(positions), numpy.concatenate(normals), numpy.concatenate(uvs), \
+        textures, numpy.concatenate(two_sided)
+
+def match_triangles(a,b,tolerance,a_attributes,b_attributes):
+    """for each triangle in a (T,3,F,3), the nearest triangle in b, the rotation of its corners
+    that lines them up with a's and how far apart they are (the furthest corner in any frame),
+    or inf if none is within tolerance.  Where several are as near, the one whose corners'
+    attributes (T,3,n) differ least is taken.  Triangles are hashed into a grid by their
+    centroid in the first frame, so only those in neighbouring cells are compared"""
+    best = numpy.full(len(a),numpy.inf)
+    best_key = numpy.full(len(a),numpy.inf)
+    best_b = numpy.zeros(len(a),dtype=numpy.int_)
+    best_r = numpy.zeros(len(a),dtype=numpy.int_)
+    if len(a) and len(b):
+        ca, cb = a[:,:,0].mean(axis=1), b[:,:,0].mean(axis=1)
+        lo = numpy.minimum(ca.min(axis=0),cb.min(axis=0))
+        extent = float((numpy.maximum(ca.max(axis=0),cb.max(axis=0))-lo).max())
+        cell = max(tolerance,extent/2.**20,1e-12)
+        ga = numpy.floor((ca-lo)/cell).astype(numpy.int64)+1
+        gb = numpy.floor((cb-lo)/cell).astype(numpy.int64)+1
+        dims = numpy.maximum(ga.max(axis=0),gb.max(axis=0))+2
+        keys = numpy.ravel_multi_index(gb.T,dims)
+        order = numpy.argsort(keys)
+        keys = keys[order]
+        for offset in numpy.array(numpy.meshgrid((-1,0,1),(-1,0,1),(-1,0,1))).reshape(3,-1).T:
+            near = numpy.ravel_multi_index((ga+offset).T,dims)
+            start, end = numpy.searchsorted(keys,near,"left"), numpy.searchsorted(keys,near,"right")
+            counts = end-start
+            if not counts.sum():
+                continue
+            ai = numpy.repeat(numpy.arange(len(a)),counts)
+            bi = order[numpy.repeat(start-(numpy.cumsum(counts)-counts),counts)+numpy.arange(counts.sum())]
+            for r in range(3):
+                rotated = [r,(r+1)%3,(r+2)%3]
+                d = a[ai]-b[bi][:,rotated]
+                d = numpy.sqrt((d*d).sum(axis=-1)).max(axis=(1,2))
+                e = a_attributes[ai]-b_attributes[bi][:,rotated]
+                # an attribute differing by 1 counts for as much as a corner moving by tolerance
+                key = d+numpy.sqrt((e*e).sum(axis=-1)).max(axis=1)*tolerance
+                better = numpy.nonzero((d <= tolerance) & (key < best_key[ai]))[0]
+                # several candidates may be better for the same triangle; keep the best
+                better = better[numpy.lexsort((key[better],ai[better]))]
+                better = better[numpy.unique(ai[better],return_index=True)[1]]
+                best[ai[better]] = d[better]
+                best_key[ai[better]] = key[better]
+                best_b[ai[better]] = bi[better]
+                best_r[ai[better]] = r
+    return best, best_b, best_r
+
+def both_sides((positions,normals,uvs,textures,two_sided)):
+    """rendered_triangles() with each two-sided triangle again, wound and facing the other
+    way, and the triangle and corners each came from"""
+    index = numpy.concatenate((numpy.arange(len(positions)),numpy.nonzero(two_sided)[0]))
+    corners = numpy.vstack((numpy.tile((0,1,2),(len(positions),1)),numpy.tile((0,2,1),(two_sided.sum(),1))))
+    facing = numpy.where(numpy.arange(len(index)) < len(positions),1.,-1.)[:,None,None,None]
+    return index, positions[index[:,None],corners], normals[index[:,None],corners]*facing, \
+        uvs[index[:,None],corners]
+
+def corner_attributes(normals,uvs):
+    return numpy.concatenate((normals.reshape(len(normals),3,-1),numpy.nan_to_num(uvs)),axis=2)
+
+def verify(original,optimised,tolerance=0.001):
+    """compares two models as drawn rather than as bytes: each triangle of the original over
+    its animation is matched to the nearest of the optimised model's (tolerance being
+    relative to the original's biggest extent), and the deviation of the positions, normals
+    and texcoords of its corners is reported along with the triangles either is missing.
+    The back of a two-sided triangle counts as facing the other way"""
+    frame_count = max([mesh.frame_count for mesh in original.meshes] or [1])
+    a = rendered_triangles(original,frame_count)
+    b = rendered_triangles(optimised,frame_count)
+    extent = float((a[0].max(axis=(0,1,2))-a[0].min(axis=(0,1,2))).max()) if len(a[0]) else 0.
+    index, positions, normals, uvs = both_sides(b)
+    distance, match, rotation = match_triangles(a[0],positions,tolerance*extent,
+        corner_attributes(a[1],a[2]),corner_attributes(normals,uvs))
+    back = both_sides(a)
+    extra = (~numpy.isfinite(match_triangles(b[0],back[1],tolerance*extent,
+        corner_attributes(b[1],b[2]),corner_attributes(back[2],back[3]))[0])).sum()
+    ai = numpy.nonzero(numpy.isfinite(distance))[0]
+    bi = match[ai,None]
+    corners = (numpy.arange(3)+rotation[ai,None])%3
+    def deviation(d):
+        d = numpy.sqrt((d*d).sum(axis=-1)).reshape(len(d),-1).max(axis=1) if len(d) else numpy.zeros(1)
+        return float(d.max()), float(d.mean())
+    textured = numpy.isfinite(a[2][ai]).all(axis=(1,2)) & numpy.isfinite(uvs[bi,corners]).all(axis=(1,2))
+    result = {"triangles":len(a[0]),"missing":len(a[0])-len(ai),"extra":int(extra),
+        "position":deviation(distance[ai][:,None]),
+        "normal":deviation(a[1][ai]-normals[bi,corners]),
+        "texcoord":deviation((a[2][ai]-uvs[bi,corners])[textured]),
+        "texture":sum(1 for i,j in zip(ai,index[bi[:,0]]) if a[3][i] != b[3][j])}
+    print "verifying %s against %s..."%(optimised,original)
+    print "\t%d of %d triangles matched within %g, %d extra"%(len(ai),len(a[0]),tolerance*extent,extra)
+    for key in ("position","normal","texcoord"):
+        print "\t%s deviation: max %g, mean %g"%((key,)+result[key])
+    if result["texture"]:
+        print "\t%d triangles have a different texture"%result["texture"]
+    return result
+
+def raw(array,dtype):
+    """the bytes of an array as dtype, without copying it if it already is"""
+    return numpy.ascontiguousarray(array,dtype).data
+
 class G3D:
 
     class Mesh:
         
-        def __init__(self,g3d,f):
+        def __init__(self,g3d,f,version=4):
             self.g3d = g3d
+            if version == 3:
+                self._read3(f)
+                return
             self.name = f.readS64()
-            self.frame_count, self.vertex_count, \
-                self.index_count = f.read("<III")
-            self.skip = f.read("b"*8*4)
+            frame_count, vertex_count, index_count = f.read("<III")
+            self.material = f.array("<f4",8) # diffuse rgb, specular rgb, specular power, opacity
             properties = f.readU32()
             self.customColour = properties&1
             self.twoSided = properties&2
             textures = f.readU32()
-            self.texture = None 
-            for t in range(5):
-                if textures&(1<<t):
-                    texture = f.readS64()
-                    if not t:
-                        self.texture = texture
-            class Frame: pass
-            self.frames = [Frame() for _ in range(self.frame_count)]
-            for frame in self.frames:
-                frame.vertices = list(f.readF32(self.vertex_count*3))
-            for frame in self.frames:
-                frame.normals = list(f.readF32(self.vertex_count*3))
-            if textures:
-                self.textures = list(f.readF32(self.vertex_count*2))
-            self.indices = list(f.read("<"+"I"*self.index_count))
+            # diffuse, specular, normal, reflection and colour mask maps
+            self.maps = [f.readS64() if textures&(1<<t) else None for t in range(5)]
+            self.vertices = f.array("<f4",frame_count*vertex_count*3).reshape(frame_count,vertex_count,3)
+            self.normals = f.array("<f4",frame_count*vertex_count*3).reshape(frame_count,vertex_count,3)
+            self.textures = f.array("<f4",vertex_count*2).reshape(vertex_count,2) if textures else None
+            self.indices = f.array("<u4",index_count)
+            
+        def _read3(self,f):
+            """reads a v3 mesh as its v4 equivalent"""
+            self.name = "mesh%d"%len(self.g3d.meshes) # v3 meshes have no names
+            frame_count, normal_count, texture_count, colour_count, vertex_count, index_count, \
+                properties = f.read("<7I")
+            self.customColour = 1 if properties&4 else 0
+            self.twoSided = properties&2
+            texture = f.readS64().replace("\\","/").lstrip("/")
+            textured = not properties&1
+            self.maps = [texture if textured else None]+[None]*4
+            self.vertices = f.array("<f4",frame_count*vertex_count*3).reshape(frame_count,vertex_count,3)
+            self.normals = f.array("<f4",normal_count*vertex_count*3).reshape(normal_count,vertex_count,3)
+            if normal_count != frame_count:
+                self.normals = resample(self.normals,frame_count)
+            self.textures = None
+            if textured:
+                # v4 has one set of texcoords; Glest reads every frame of them into the same
+                # buffer, so it draws with the last, and that is the one kept
+                textures = f.array("<f4",texture_count*vertex_count*2).reshape(texture_count,vertex_count,2)
+                if texture_count > 1:
+                    print "### %s: %d frames of texcoords; only the last is kept"%(self.name,texture_count)
+                self.textures = textures[-1] if texture_count else \
+                    numpy.zeros((vertex_count,2),dtype=numpy.float32)
+            # a colour and opacity, then colour_count-1 more frames of them that Glest ignores
+            colour = f.array("<f4",4*max(colour_count,1))
+            self.material = numpy.array((colour[0],colour[1],colour[2],0,0,0,0,colour[3]),dtype=numpy.float32)
+            self.indices = f.array("<u4",index_count)
+            
+        frame_count = property(lambda self: len(self.vertices))
+        vertex_count = property(lambda self: self.vertices.shape[1])
+        index_count = property(lambda self: len(self.indices))
+        texture = property(lambda self: self.maps[0])
+            
+        def size(self):
+            """bytes the mesh takes in a G3D file"""
+            return 64+12+32+8+64*sum(1 for m in self.maps if m)+self.frame_count*self.vertex_count*3*4*2+ \
+                (self.vertex_count*2*4 if self.textures is not None else 0)+self.index_count*4
+            
+        def state(self):
+            """everything that must match for meshes to be drawn as one"""
+            return (tuple(self.maps),self.material.tobytes(),self.customColour,self.twoSided,self.frame_count)
+            
+        def blended(self):
+            """whether what is drawn behind the mesh shows through it, so it must be drawn in order:
+            it isn't fully opaque or its texture has an alpha channel"""
+            if self.material[7] < 1:
+                return True
+            if not self.texture:
+                return False
+            try:
+                return img_header.read_header(texture_path(self.g3d.name,self.texture)).channels in (2,4)
+            except Exception:
+                return True # can't tell, so keep its place
+            
+        def vertex_rows(self,tolerance,normals=True):
+            """a row per vertex of its position and normal in every frame and its texcoords,
+            quantized to tolerance, so that equal rows are the same vertex"""
+            columns = [self.vertices]+([self.normals] if normals else [])+([self.textures[None]] if self.textures is not None else [])
+            rows = numpy.hstack([c.transpose(1,0,2).reshape(self.vertex_count,-1) for c in columns])
+            return numpy.round(rows/tolerance).astype(numpy.int64)
+            
+        def duplicates(self,tolerance):
+            """for each vertex, the first vertex that is the same as it"""
+            if not self.vertex_count:
+                return numpy.zeros(0,dtype=numpy.int_)
+            unique, first, inverse = numpy.unique(self.vertex_rows(tolerance),axis=0,
+                return_index=True,return_inverse=True)
+            return first[inverse]
+            
+        def compact(self,order=None):
+            """keeps just the vertices in order (by default, those the indices use, as they
+            are now ordered) and rewrites the indices to match; order must hold every
+            vertex the indices use"""
+            if order is None:
+                order = numpy.unique(self.indices)
+            mapping = numpy.zeros(self.vertex_count,dtype=numpy.uint32)
+            mapping[order] = numpy.arange(len(order),dtype=numpy.uint32)
+            self.indices = mapping[self.indices]
+            self.vertices = self.vertices[:,order]
+            self.normals = self.normals[:,order]
+            if self.textures is not None:
+                self.textures = self.textures[order]
+            
+        def weld(self,tolerance):
+            """merges vertices that are the same, to within tolerance, in every frame
+            and drops those no triangle uses"""
+            before, vertex_count = self.size(), self.vertex_count
+            self.indices = self.duplicates(tolerance)[self.indices]
+            self.compact()
+            print "\t%s: %d of %d vertices welded or unused, %d bytes saved"%(self.name,
+                vertex_count-self.vertex_count,vertex_count,before-self.size())
+            return before-self.size()
+            
+        def optimise_cache(self,cache_size):
+            """reorders the triangles for the vertex cache, reporting the average cache miss
+            ratio (misses per triangle) and average transform to vertex ratio before and after"""
+            if self.index_count < 3:
+                return
+            used = len(numpy.unique(self.indices))
+            before = cache_misses(self.indices.tolist(),cache_size)
+            indices = tipsify(self.indices[:self.index_count//3*3],self.vertex_count,cache_size)
+            after = cache_misses(indices.tolist(),cache_size)
+            if after < before:
+                self.indices = indices
+            else:
+                after = before
+            triangles = float(self.index_count//3)
+            print "\t%s: ACMR %.3f -> %.3f, ATVR %.3f -> %.3f"%(self.name,before/triangles,after/triangles,
+                before/float(used),after/float(used))
+            
+        def reorder_vertices(self):
+            """renumbers the vertices in the order the indices first use them, for
+            fetch locality, dropping those no triangle uses"""
+            before, vertex_count = self.size(), self.vertex_count
+            used, first = numpy.unique(self.indices,return_index=True)
+            self.compact(used[numpy.argsort(first)])
+            print "\t%s: %d of %d vertices unused, %d bytes saved"%(self.name,
+                vertex_count-self.vertex_count,vertex_count,before-self.size())
+            return before-self.size()
+            
+        def lod_indices(self,ratios,tolerance):
+            """simplified indices keeping each of ratios of the triangles, and their errors.
+            Vertices on UV seams or hard edges (another vertex shares their position), on the
+            mesh's boundary or on non-manifold edges are locked, so that texturing holds"""
+            triangles = self.indices[:self.index_count//3*3].reshape(-1,3)
+            locked = numpy.zeros(self.vertex_count,dtype=bool)
+            positions = numpy.round(self.vertices.transpose(1,0,2).reshape(self.vertex_count,-1)/tolerance)
+            unique, inverse, counts = numpy.unique(positions.astype(numpy.int64),axis=0,
+                return_inverse=True,return_counts=True)
+            locked |= counts[inverse] > 1
+            edges = numpy.sort(numpy.vstack((triangles[:,(0,1)],triangles[:,(1,2)],triangles[:,(2,0)])),axis=1)
+            edges, counts = numpy.unique(edges,axis=0,return_counts=True)
+            locked[edges[counts != 2].ravel()] = True
+            targets = [int(math.ceil(len(triangles)*ratio)) for ratio in ratios]
+            return simplify(self.vertices,triangles,locked,targets), locked[numpy.unique(triangles)].sum()
+            
+        def split_static(self,tolerance):
+            """the mesh split into the triangles that move and a mesh of a single frame of those
+            whose vertices are the same, to within tolerance, in every frame.  Blended meshes are
+            only split if that keeps the order their triangles are drawn in"""
+            if self.frame_count < 2:
+                return [self]
+            still = (numpy.abs(self.vertices-self.vertices[0]) <= tolerance).all(axis=(0,2)) & \
+                (numpy.abs(self.normals-self.normals[0]) <= tolerance).all(axis=(0,2))
+            triangles = self.indices[:self.index_count//3*3].reshape(-1,3)
+            static = still[triangles].all(axis=1)
+            if not static.any():
+                return [self]
+            if self.blended() and not in_order(~static,static):
+                # the static mesh would be drawn after moving triangles it was drawn before
+                print "\t%s: not split, as it is blended and its static triangles are drawn between moving ones"%self.name
+                return [self]
+            parts = []
+            if not static.all():
+                moving = copy.copy(self)
+                moving.indices = triangles[~static].ravel()
+                moving.compact()
+                parts.append(moving)
+            mesh = copy.copy(self)
+            if parts:
+                mesh.name = self.name+"_static"
+            mesh.indices = triangles[static].ravel()
+            mesh.vertices = self.vertices[:1]
+            mesh.normals = self.normals[:1]
+            mesh.compact()
+            parts.append(mesh)
+            print "\t%s: %d of %d triangles static, %d of %d vertices still animated, %d bytes saved"%(self.name,
+                static.sum(),len(triangles),parts[0].vertex_count if len(parts) > 1 else 0,self.vertex_count,
+                self.size()-sum(part.size() for part in parts))
+            return parts
+            
+        def texture_size(self):
+            """the (w,h) of the first texture map, read from its header, or None"""
+            for m in self.maps:
+                if m:
+                    try:
+                        header = img_header.read_header(texture_path(self.g3d.name,m))
+                        return header.w, header.h
+                    except Exception:
+                        pass
+            return None
+            
+        def quantize(self,error):
+            """snaps positions to a power of two grid within error of the mesh's biggest extent,
+            normals within error and texcoords to subtexels; returns the furthest any point of
+            each moved.  Each axis is rounded separately, so a point can move sqrt(n) times as
+            far as along any one axis, and the steps allow for that"""
+            extent = float((self.vertices.max(axis=(0,1))-self.vertices.min(axis=(0,1))).max()) \
+                if self.vertices.size else 0.
+            errors = [0.,0.,0.]
+            if extent > 0:
+                self.vertices, errors[0] = snap(self.vertices,pow2_step(error*extent/math.sqrt(3)))
+            self.normals, errors[1] = snap(self.normals,pow2_step(error/math.sqrt(3)))
+            if self.textures is not None:
+                size = self.texture_size()
+                step = numpy.array([pow2_step(.5/(s*subtexels)) for s in size] if size else [pow2_step(error/math.sqrt(2))]*2)
+                self.textures, errors[2] = snap(self.textures,step)
+            return errors
+            
+        def clean(self,tolerance):
+            """drops triangles that have no area in any frame and duplicates of others, and
+            collapses pairs of triangles back to back (the same corners, by position in every
+            frame and texcoords, wound the other way) into one two-sided triangle.  Returns the
+            mesh and, if only some triangles were in such pairs, a two-sided mesh of them; a
+            blended mesh keeps such pairs unless that mesh would be drawn after the rest"""
+            triangles = self.indices[:self.index_count//3*3].reshape(-1,3)
+            count = len(triangles)
+            if not count:
+                return [self]
+            ids = numpy.unique(self.vertex_rows(tolerance,False),axis=0,return_inverse=True)[1][triangles]
+            corners = self.vertices[:,triangles] # (F,T,3,3)
+            area = numpy.cross(corners[:,:,1]-corners[:,:,0],corners[:,:,2]-corners[:,:,0])
+            solid = (numpy.sqrt((area*area).sum(axis=-1)) > tolerance*tolerance).any(axis=0)
+            solid &= (ids[:,0] != ids[:,1]) & (ids[:,1] != ids[:,2]) & (ids[:,2] != ids[:,0])
+            triangles, ids = triangles[solid], ids[solid]
+            degenerate = count-len(triangles)
+            # rotated so the lowest corner is first, keeping the winding
+            def canonical(ids):
+                first = numpy.argmin(ids,axis=1)[:,None]
+                return ids[numpy.arange(len(ids))[:,None],(first+numpy.arange(3))%3]
+            unique, keep = numpy.unique(canonical(ids),axis=0,return_index=True)
+            keep.sort()
+            duplicates = len(triangles)-len(keep)
+            triangles, ids = triangles[keep], ids[keep]
+            both, inverse = numpy.unique(numpy.vstack((canonical(ids),canonical(ids[:,(0,2,1)]))),axis=0,
+                return_inverse=True)
+            triangle_of = numpy.full(len(both),-1)
+            triangle_of[inverse[:len(ids)]] = numpy.arange(len(ids))
+            back = triangle_of[inverse[len(ids):]] # the triangle behind each, if any
+            front = back > numpy.arange(len(ids)) # the first of each pair is kept
+            paired = front | ((back >= 0) & ~front)
+            parts = [self]
+            if self.twoSided or paired.all() or not front.any():
+                # a two-sided mesh already draws the back, or the whole mesh can be two-sided
+                self.indices = triangles[~paired | front].ravel()
+                if front.any():
+                    self.twoSided = 2
+            elif self.blended() and not in_order(~paired,front):
+                # a two-sided mesh of the pairs would be drawn after triangles it was drawn before
+                self.indices = triangles.ravel()
+                front[:] = False
+            else:
+                two_sided = copy.copy(self)
+                two_sided.name = self.name+"_2sided"
+                two_sided.twoSided = 2
+                two_sided.indices = triangles[front].ravel()
+                two_sided.compact()
+                self.indices = triangles[~paired].ravel()
+                parts.append(two_sided)
+            self.compact()
+            pairs = front.sum()
+            print "\t%s: %d degenerate, %d duplicate and %d back to back triangles removed%s"%(self.name,
+                degenerate,duplicates,pairs," (now two-sided)" if pairs and len(parts) == 1 else "")
+            return parts
             
         def write(self,f):
-            f.write(struct.pack("c"*64,*self.name.ljust(64,'\x00')))
-            f.write(struct.pack("<III",self.frame_count,self.vertex_count,self.index_count))
-            f.write(struct.pack("b"*8*4,*self.skip))
-            f.write(struct.pack("<I",self.customColour|self.twoSided))
-            f.write(struct.pack("<I",1 if self.texture else 0))
-            if self.texture:
-                f.write(struct.pack("c"*64,*self.texture.ljust(64,'\x00')))
-            for frame in self.frames:
-                f.write(struct.pack("<"+"f"*self.vertex_count*3,*frame.vertices))
-            for frame in self.frames:
-                f.write(struct.pack("<"+"f"*self.vertex_count*3,*frame.normals))
-            if self.texture:
-                f.write(struct.pack("<"+"f"*self.vertex_count*2,*self.textures))
-            f.write(struct.pack("<"+"I"*self.index_count,*self.indices))
+            # file.writelines() would copy each buffer into a string first
+            for data in (struct.pack("<64sIII",self.name,self.frame_count,self.vertex_count,self.index_count),
+                raw(self.material,"<f4"),
+                struct.pack("<II",self.customColour|self.twoSided,sum(1<<t for t,m in enumerate(self.maps) if m)),
+                "".join(struct.pack("<64s",m) for m in self.maps if m),
+                raw(self.vertices,"<f4"),
+                raw(self.normals,"<f4"),
+                raw(self.textures,"<f4") if self.textures is not None else "",
+                raw(self.indices,"<u4")):
+                f.write(data)
 
         def __repr__(self):
             return self.name
@@ -74,7 +712,13 @@ class G3D:
         self.name = name
         self.meshes = []
         f = Reader(bytes)
-        if f.read("cccb") != ('G','3','D',4):
+        magic = f.read("cccb")
+        if magic == ('G','3','D',3):
+            # converted to v4 as it is read, so it is written as v4
+            for i in range(f.readU32()):
+                self.meshes.append(self.Mesh(self,f,3))
+            return
+        if magic != ('G','3','D',4):
             raise Exception("bad magic")
         mesh_count = f.readU16()
         if f.readU8():
@@ -85,71 +729,165 @@ class G3D:
     def __repr__(self):
         return self.name
         
-    def analyse(self):
+    def analyse(self,tolerance=0.0001):
         print "analysing duplication of vertices and triangles in meshes..."
         for mesh in self.meshes:
             print "\t",mesh.name
-            vertices = [[] for vertex in range(mesh.vertex_count)]
-            for frame in mesh.frames:
-                for i in range(mesh.vertex_count):
-                    vertices[i] += [round(j,4) for j in frame.vertices[i*3:i*3+3]]
-                    vertices[i] += [round(j,4) for j in frame.normals[i*3:i*3+3]]
-                    if mesh.texture:
-                        vertices[i] += [round(j,4) for j in mesh.textures[i*2:i*2+2]]
-            vertices = [tuple(vertex) for vertex in vertices]
-            unique = {vertex:i for i,vertex in reversed(list(enumerate(vertices)))}
-            mapping = [unique[vertex] for vertex in vertices]
-            print "\t\t",mesh.vertex_count-len(unique),"dup vertices"
-            triangles = set(tuple(sorted((mapping[j] for j in mesh.indices[i:i+3]))) for i in range(0,mesh.index_count,3))
-            print "\t\t",len(mesh.indices)/3-len(triangles),"dup triangles"
-            print "\t\t",len(filter(lambda i: mapping[i] != i,mesh.indices)),"dup indices are actually used"
-            print "\t\t",mesh.vertex_count-len(set(mesh.indices)),"un-used vertices"
+            mapping = mesh.duplicates(tolerance)
+            print "\t\t",mesh.vertex_count-len(numpy.unique(mapping)),"dup vertices"
+            triangles = numpy.sort(mapping[mesh.indices[:mesh.index_count//3*3]].reshape(-1,3),axis=1)
+            print "\t\t",len(triangles)-len(numpy.unique(triangles,axis=0)),"dup triangles"
+            print "\t\t",(mapping[mesh.indices] != mesh.indices).sum(),"dup indices are actually used"
+            print "\t\t",mesh.vertex_count-len(numpy.unique(mesh.indices)),"un-used vertices"
+            
+    def weld(self,tolerance=0.0001):
+        print "welding duplicate vertices..."
+        saved = sum(mesh.weld(tolerance) for mesh in self.meshes)
+        print "\t%d bytes saved"%saved
+            
+    def optimise_cache(self,cache_size=16):
+        print "optimising triangle order for a %d entry vertex cache..."%cache_size
+        for mesh in self.meshes:
+            mesh.optimise_cache(cache_size)
+            
+    def reorder_vertices(self):
+        print "reordering vertices by first use..."
+        saved = sum(mesh.reorder_vertices() for mesh in self.meshes)
+        print "\t%d bytes saved"%saved
+            
+    def lods(self,ratios=(.5,.25),tolerance=0.0001):
+        """copies of the model with each mesh simplified to each ratio of its triangles"""
+        print "simplifying for levels of detail %s..."%", ".join("%g"%ratio for ratio in ratios)
+        lods = [copy.copy(self) for ratio in ratios]
+        for lod in lods:
+            lod.meshes = []
+        for mesh in self.meshes:
+            simplified, locked = mesh.lod_indices(ratios,tolerance)
+            print "\t%s: %d triangles, %d vertices locked"%(mesh,mesh.index_count//3,locked)
+            for lod,ratio,(indices,error) in zip(lods,ratios,simplified):
+                m = copy.copy(mesh)
+                m.indices = indices.ravel()
+                m.compact()
+                lod.meshes.append(m)
+                print "\t\t%g: %d triangles, %d vertices, error %g"%(ratio,m.index_count//3,m.vertex_count,error)
+        for lod,ratio in zip(lods,ratios):
+            print "\t%g: %d of %d triangles, %d of %d bytes"%(ratio,
+                sum(m.index_count//3 for m in lod.meshes),sum(m.index_count//3 for m in self.meshes),
+                sum(m.size() for m in lod.meshes),sum(m.size() for m in self.meshes))
+        return lods
+            
+    def clean(self,tolerance=0.0001):
+        print "removing degenerate, duplicate and back to back triangles..."
+        before = sum(mesh.index_count//3 for mesh in self.meshes)
+        self.meshes = [part for mesh in self.meshes for part in mesh.clean(tolerance)]
+        print "\t%d triangles removed"%(before-sum(mesh.index_count//3 for mesh in self.meshes))
+            
+    def split_static(self,tolerance=0.0001):
+        print "splitting off static parts..."
+        before = sum(mesh.size() for mesh in self.meshes)
+        animated = sum(mesh.vertex_count for mesh in self.meshes if mesh.frame_count > 1)
+        self.meshes = [part for mesh in self.meshes for part in mesh.split_static(tolerance)]
+        print "\t%d bytes saved; %d vertices interpolated each frame rather than %d"%( \
+            before-sum(mesh.size() for mesh in self.meshes),
+            sum(mesh.vertex_count for mesh in self.meshes if mesh.frame_count > 1),animated)
+            
+    def quantize(self,error=0.0005):
+        print "quantizing to within %g..."%error
+        before = cStringIO.StringIO()
+        self.write(before)
+        for mesh in self.meshes:
+            print "\t%s: positions moved up to %g, normals %g, texcoords %g"%((mesh,)+tuple(mesh.quantize(error)))
+        after = cStringIO.StringIO()
+        self.write(after)
+        before, after = before.getvalue(), after.getvalue()
+        for name,b,a in zip(("deflate","xz"),compressed_sizes(before),compressed_sizes(after)):
+            if b is not None:
+                print "\t%s: %d -> %d bytes (ratio %.2f -> %.2f)"%(name,b,a,
+                    float(len(before))/b,float(len(after))/a)
             
     def auto_join_frames(self):
+        """joins meshes with the same state into as few meshes as fit under max_indices each.
+        Opaque meshes are drawn first, as the depth buffer sorts them out whatever their order;
+        blended meshes keep their order after them, so only runs of them are joined"""
         print "auto-joining compatible meshes..."
-        print "### TODO account for opacity, z-order etc"
         print "### selectable ought to be joinable if we have an int instead of a boolean"
-        meshes = {}
+        opaque, blended = {}, []
         for mesh in self.meshes:
-            key = (mesh.texture,mesh.frame_count,mesh.twoSided|mesh.customColour)
-            if key in meshes:
-                meshes[key].append(mesh)
+            if not mesh.blended():
+                opaque.setdefault(mesh.state(),[]).append(mesh)
+            elif blended and blended[-1][0] == mesh.state():
+                blended[-1][1].append(mesh)
             else:
-                meshes[key] = [mesh]
-        for joinable in meshes.values():
-            if len(joinable) < 2: continue
-            base = joinable[0]
-            print "\tjoining to",base
-            for mesh in joinable[1:]:
-                if base.index_count+mesh.index_count > 0xffff:
-                    base = mesh
-                    print "\tjoining to",base
-                    continue
-                print "\t\t",mesh
-                for a,b in zip(base.frames,mesh.frames):
-                    a.vertices.extend(b.vertices)
-                    a.normals.extend(b.normals)
-                if base.texture:
-                    base.textures.extend(mesh.textures)
-                base.indices.extend(index+base.vertex_count for index in mesh.indices)
-                base.vertex_count += mesh.vertex_count
-                base.index_count += mesh.index_count
-                self.meshes.remove(mesh)
+                blended.append((mesh.state(),[mesh]))
+        groups = [(meshes,False) for meshes in sorted(opaque.values(),key=lambda meshes: self.meshes.index(meshes[0]))]
+        groups += [(meshes,True) for state,meshes in blended]
+        draw_calls = len(self.meshes)
+        self.meshes = []
+        for meshes,ordered in groups:
+            for bin in pack_bins([mesh.index_count for mesh in meshes],max_indices,ordered):
+                if len(bin) > 1:
+                    print "\tjoining %s%s"%(", ".join(str(meshes[i]) for i in bin)," (blended)" if ordered else "")
+                self.meshes.append(join_meshes([meshes[i] for i in bin]))
+        print "\t%d meshes joined into %d, %d draw calls saved"%(draw_calls,len(self.meshes),draw_calls-len(self.meshes))
                 
-    def smooth_frames(self):
-        print "smoothing frames..."
-        
+    def smooth_frames(self,tolerance=0.001,uniform=False):
+        """drops the frames that linear interpolation of their neighbours reproduces, positions
+        and normals, to within tolerance.  Meshes with the same number of frames keep the same
+        frames, so they stay in step.  Glest spaces frames evenly over the animation, so keeping
+        an uneven subset changes the timing; uniform instead resamples to the fewest evenly
+        spaced frames that are within tolerance, which keeps the timing.  Meshes with different
+        numbers of frames are always resampled uniformly, as uneven subsets of each would put
+        them out of step with each other"""
+        groups = {}
+        for mesh in self.meshes:
+            if mesh.frame_count > 1:
+                groups.setdefault(mesh.frame_count,[]).append(mesh)
+        if (not uniform) and (len(groups) > 1):
+            print "meshes have %s frames; only uniform resampling keeps them in step"% \
+                " and ".join(map(str,sorted(groups)))
+            uniform = True
+        print "smoothing frames%s..."%(" by uniform resampling" if uniform else "")
+        saved = 0
+        for frame_count,meshes in sorted(groups.items()):
+            before = sum(mesh.size() for mesh in meshes)
+            frames = numpy.concatenate([numpy.concatenate((mesh.vertices,mesh.normals),axis=1) \
+                for mesh in meshes],axis=1)
+            if uniform:
+                count = 1
+                while (count < frame_count) and (resample_error(frames,count) > tolerance):
+                    count += 1
+                if count == frame_count:
+                    error = 0.
+                else:
+                    error = resample_error(frames,count)
+                    for mesh in meshes:
+                        mesh.vertices = resample(mesh.vertices,count)
+                        mesh.normals = resample(mesh.normals,count)
+            else:
+                keys, error = keyframes(frames,tolerance)
+                count = len(keys)
+                for mesh in meshes:
+                    mesh.vertices = mesh.vertices[keys]
+                    mesh.normals = mesh.normals[keys]
+            after = sum(mesh.size() for mesh in meshes)
+            saved += before-after
+            print "\t%s: %d of %d frames kept, error %g, %d bytes saved"%(", ".join(map(str,meshes)),
+                count,frame_count,error,before-after)
+            if not uniform and count < frame_count:
+                # frame keys[k] used to play at keys[k]/frame_count of the way through, now k/count
+                shift = [float(k)/count-float(key)/frame_count for k,key in enumerate(keys)]
+                print "\t\tkept frames %s; timing shifts by up to %.1f%% of the animation"%( \
+                    " ".join(map(str,keys)),100.*max(map(abs,shift)))
+        print "\t%d bytes saved"%saved
 
     def rename_texture(self,old,new):
         for mesh in self.meshes:
-            if mesh.texture == old:
+            if old in mesh.maps:
                 print "renaming",old,"to",new,"in",mesh
-                mesh.texture = new
+                mesh.maps = [new if m == old else m for m in mesh.maps]
 
     def write(self,f):
-        f.write(struct.pack("cccb",'G','3','D',4))
-        f.write(struct.pack("<H",len(self.meshes)))
-        f.write(struct.pack("b",0))
+        f.write(struct.pack("<3sBHB","G3D",4,len(self.meshes),0))
         for mesh in self.meshes:
             mesh.write(f)
 
@@ -159,24 +897,207 @@ class G3D:
             print "\t%s has %d frames, %d vertices and %d indices"% \
                 (mesh.name,mesh.frame_count,mesh.vertex_count,mesh.index_count)
         
-if __name__=="__main__":
-    opts, args = getopt.getopt(sys.argv[1:],None,("join","smooth","analyse"))
-    if len(args) not in (1,2):
-        sys.exit("usage: python %s {--join} {--analyse} {--smooth} [src] {dest}"%sys.argv[0])
-    opts = dict(opts)
-    src = args[0]
+def summary(g3d):
+    return {"meshes":len(g3d.meshes),"bytes":8+sum(mesh.size() for mesh in g3d.meshes),
+        "vertices":sum(mesh.frame_count*mesh.vertex_count for mesh in g3d.meshes),
+        "triangles":sum(mesh.index_count//3 for mesh in g3d.meshes)}
+
+def optimise(src,dest,opts,name=None):
+    """runs the passes opts (as given on the command line) select on src, writing
+    it to dest if given, and returns the summary of the model before and after.
+    LODs are named after name, if dest is only where the model is written for now"""
+    tolerance = float(opts.get("--tolerance",0.0001))
     print "loading",src,"..."
-    g3d = G3D(src,file(src,"rb").read())
+    data = file(src,"rb").read()
+    g3d = G3D(src,data)
+    before = summary(g3d)
     g3d.desc()
+    if "--clean" in opts:
+        g3d.clean(tolerance)
+        g3d.desc()
+    if "--static" in opts:
+        g3d.split_static(tolerance)
+        g3d.desc()
     if "--join" in opts:
         g3d.auto_join_frames()
         g3d.desc()
+    if "--weld" in opts:
+        g3d.weld(tolerance)
+        g3d.desc()
+    if "--cache" in opts:
+        g3d.optimise_cache(int(opts.get("--cache-size",16)))
+    if "--reorder" in opts:
+        g3d.reorder_vertices()
+        g3d.desc()
     if "--analyse" in opts:
-        g3d.analyse()
+        g3d.analyse(tolerance)
     if "--smooth" in opts:
-        g3d.smooth_frames()
+        g3d.smooth_frames(float(opts.get("--frame-tolerance",0.001)),"--uniform" in opts)
         g3d.desc()
-    if len(args) == 2:
-        dest = args[1]
+    if "--quantize" in opts:
+        g3d.quantize(float(opts.get("--quantize-error",0.0005)))
+    if dest:
         print "saving",dest,"..."
         g3d.write(file(dest,"wb"))
+    after = summary(g3d)
+    if "--verify" in opts:
+        # check what was written by reading it back
+        after["verify"] = verify(G3D(src,data),G3D(dest,file(dest,"rb").read()) if dest else g3d,
+            float(opts.get("--verify-tolerance",0.001)))
+    if ("--lod" in opts) and ("verify" in after) and (after["verify"]["missing"] or after["verify"]["extra"]):
+        print "### not making LODs, as the model lost or gained triangles"
+    elif "--lod" in opts:
+        # model.g3d -> model_lod1.g3d, model_lod2.g3d ...
+        ratios = [float(ratio) for ratio in opts.get("--lod-ratios","0.5,0.25").split(",")]
+        base, ext = os.path.splitext(name or dest or src)
+        for i,lod in enumerate(g3d.lods(ratios,tolerance)):
+            if "--cache" in opts:
+                lod.optimise_cache(int(opts.get("--cache-size",16)))
+            lod_dest = "%s_lod%d%s"%(base,i+1,ext)
+            print "saving",lod_dest,"..."
+            lod.write(file(lod_dest,"wb"))
+    return before, after
+
+batch_opts = ("--batch","--out","--jobs","--verify","--verify-tolerance") # options that don't change what a model is optimised into
+
+def find_models(paths,out=None):
+    """(src,dest) of every model under paths, other than LODs made by a previous run;
+    dest mirrors each path under out or, without out, is src itself"""
+    models = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isfile(path):
+            found = [path]
+            root = os.path.dirname(path)
+        else:
+            found = [os.path.join(folder,f) for folder,dirs,files in os.walk(path) for f in files \
+                if os.path.splitext(f)[1].lower() == ".g3d"]
+            root = os.path.dirname(path.rstrip("\\/"))
+        for src in sorted(found):
+            if re.search(r"_lod[0-9]+\.g3d$",src,re.I):
+                continue
+            models.append((src,os.path.join(out,os.path.relpath(src,root)) if out else src))
+    return models
+
+def batch_job((src,dest,opts)):
+    """optimises a model in a worker, keeping what it prints to show only if it fails.
+    The model is written beside dest and verified, and only replaces dest if it has
+    the same triangles; otherwise dest, which may be src, is left as it was"""
+    log, stdout = cStringIO.StringIO(), sys.stdout
+    sys.stdout = log
+    folder, filename = os.path.split(dest)
+    temp = os.path.join(folder,".%s.tmp"%filename)
+    try:
+        try:
+            os.makedirs(folder)
+        except OSError,e:
+            if e.errno != errno.EEXIST: # another worker made it first
+                raise
+        before, after = optimise(src,temp,opts,dest)
+        check = after["verify"]
+        if check["missing"] or check["extra"]:
+            os.remove(temp)
+        else:
+            if os.name == "nt" and os.path.isfile(dest):
+                os.remove(dest) # rename won't replace a file on Windows
+            os.rename(temp,dest)
+        return src, dest, before, after, None
+    except Exception:
+        traceback.print_exc(file=log)
+        if os.path.isfile(temp):
+            os.remove(temp)
+        return src, dest, None, None, log.getvalue()
+    finally:
+        sys.stdout = stdout
+
+def batch(paths,opts,out=None,jobs=None):
+    """optimises every model under paths in a pool of processes, writing them under out or in
+    place, and verifies each against the original.  Models whose content, textures and options
+    are unchanged since the last run, as recorded in g3d_optimise.json in out (or the current
+    folder), are skipped"""
+    import multiprocessing
+    opts = dict(opts,**{"--verify":""})
+    settings = dict((key,value) for key,value in opts.iteritems() if key not in batch_opts)
+    cache_filename = os.path.join(out or ".","g3d_optimise.json")
+    cache = json.load(open(cache_filename)) if os.path.isfile(cache_filename) else {}
+    models, skipped = [], 0
+    for src,dest in find_models(paths,out):
+        key = cache_key(src,settings)
+        # in place, src is what the last run wrote
+        if (key in cache.get(dest,{}).values()) and os.path.isfile(dest):
+            skipped += 1
+        else:
+            models.append((src,dest,opts))
+    print "%d of %d models are up to date; optimising %d..."%(skipped,skipped+len(models),len(models))
+    totals = dict((key,[0,0]) for key in ("meshes","bytes","vertices","triangles"))
+    failed, differ, worst = 0, [], 0.
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for src,dest,before,after,log in pool.imap_unordered(batch_job,models):
+            if log is not None:
+                print "### could not optimise",src
+                print log
+                failed += 1
+                cache.pop(dest,None)
+                continue
+            check = after.pop("verify")
+            print "%s: %d -> %d bytes, %d -> %d meshes, deviation %g, %d triangles missing, %d extra"%( \
+                os.path.relpath(dest,out or "."),before["bytes"],after["bytes"],before["meshes"],after["meshes"],
+                check["position"][0],check["missing"],check["extra"])
+            worst = max(worst,check["position"][0])
+            if check["missing"] or check["extra"]:
+                # so was not written, and is tried again next time
+                differ.append(dest)
+                cache.pop(dest,None)
+                continue
+            for key,total in totals.iteritems():
+                total[0] += before[key]
+                total[1] += after[key]
+            cache[dest] = {"src":cache_key(src,settings),"dest":cache_key(dest,settings)}
+    finally:
+        pool.close()
+        pool.join()
+        json.dump(cache,open(cache_filename,"w"),indent=1,sort_keys=True)
+    print "%d models optimised, %d failed, %d left as they were, %d skipped"%(len(models)-failed-len(differ),failed,len(differ),skipped)
+    print "\tworst deviation %g; %d models lost or gained triangles, so were left as they were%s"%(worst,len(differ),
+        "".join("\n\t\t"+dest for dest in sorted(differ)))
+    for key in ("bytes","meshes","vertices","triangles"):
+        b, a = totals[key]
+        print "\t%-10s %12d -> %12d (%+.1f%%)"%(key,b,a,100.*(a-b)/b if b else 0.)
+
+if __name__=="__main__":
+    opts, args = getopt.getopt(sys.argv[1:],None,("join","smooth","analyse","weld","tolerance=","cache","cache-size=","reorder",
+        "frame-tolerance=","uniform","lod","lod-ratios=","static",
+        "quantize","quantize-error=","batch","out=","jobs=","verify","verify-tolerance=","diff","clean"))
+    opts = dict(opts)
+    if (("--batch" not in opts) and len(args) not in (1,2)) or not args or (("--diff" in opts) and len(args) != 2):
+        sys.exit("""usage: python %s {options} [src] {dest}
+       python %s --batch {--out=folder} {--jobs=N} {options} [folder or model] ...
+       python %s --diff {--verify-tolerance=0.001} [original] [optimised]
+options, in the order the passes run:
+    --clean remove degenerate and duplicate triangles; make back to back pairs two-sided
+    --static split off the parts of meshes that don't move into single-frame meshes
+    --join join meshes that are drawn the same way
+    --weld merge duplicate vertices and drop unused ones
+    --tolerance=0.0001 how close vertices must be to be the same
+    --cache reorder triangles for the vertex cache
+    --cache-size=16 entries in the vertex cache
+    --reorder renumber vertices in the order triangles use them
+    --analyse report duplicate vertices and triangles
+    --smooth drop frames that interpolation reproduces
+    --frame-tolerance=0.001 how close interpolated frames must be
+    --uniform resample to evenly spaced frames rather than dropping them
+    --quantize snap geometry to grids so that it compresses better
+    --quantize-error=0.0005 how far geometry may move, relative to mesh size
+    --lod write model_lod1.g3d, model_lod2.g3d ... simplified with quadric error metrics
+    --lod-ratios=0.5,0.25 share of triangles kept at each level
+    --verify compare the model written with the original, as drawn
+    --verify-tolerance=0.001 how far triangles may move, relative to model size
+batch mode optimises every model in the folders in a pool of processes, in place
+or mirrored under --out, skipping those unchanged since the last run, and verifies them"""%((sys.argv[0],)*3))
+    if "--diff" in opts:
+        verify(*[G3D(arg,file(arg,"rb").read()) for arg in args],tolerance=float(opts.get("--verify-tolerance",0.001)))
+    elif "--batch" in opts:
+        batch(args,opts,opts.get("--out"),int(opts["--jobs"]) if "--jobs" in opts else None)
+    else:
+        optimise(args[0],args[1] if len(args) == 2 else None,opts)
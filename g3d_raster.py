@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+""" software renderer for G3D models, using nothing but numpy
+    It draws a g3d.G3D frame the way g3d_thumb does with OpenGL: the same pose,
+    scaling, GL_LIGHT0 set up by make_glut(), alpha test, blending, mipmapping and
+    the texture environments that g3d.Mesh.draw_gl_ffp() selects.  No GL context is
+    needed, so thumbnails can be made in plain worker processes on every core.
+    Triangles are binned into pixel tiles and each tile is rasterized as one
+    (triangles x pixels) array; fragments are then depth-tested and blended
+    in draw order, one 'layer' of depth complexity at a time.
+"""
+
+import math, numpy
+import g3d
+
+alpha_ref = .4 # glAlphaFunc(GL_GREATER,.4)
+scene_ambient = .2 # GL_LIGHT_MODEL_AMBIENT default
+light_ambient = .3
+light_diffuse = 1.
+light_dir = numpy.array((1.,1.,1.))/math.sqrt(3.) # GL_POSITION (1,1,1,0) given in eye space
+
+def rotation(pose):
+    """the matrix that glRotate(x,1,0,0);glRotate(y,0,1,0);glRotate(z,0,0,1) multiplies by"""
+    def rotate(angle,axis):
+        c, s = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        x, y, z = axis
+        return numpy.array((
+            (x*x*(1-c)+c,   x*y*(1-c)-z*s, x*z*(1-c)+y*s),
+            (y*x*(1-c)+z*s, y*y*(1-c)+c,   y*z*(1-c)-x*s),
+            (z*x*(1-c)-y*s, z*y*(1-c)+x*s, z*z*(1-c)+c)))
+    return rotate(pose[0],(1,0,0)).dot(rotate(pose[1],(0,1,0))).dot(rotate(pose[2],(0,0,1)))
+
+def sample(texture,uv,filtering,opaque=False):
+    """GL_CLAMP lookup of uv (N,2) in texture (h,w,4), whose first row is t=0;
+    opaque is whether the texture was uploaded as GL_RGB"""
+    h, w = texture.shape[:2]
+    uv = numpy.clip(uv,0.,1.)
+    if filtering == "nearest":
+        x = numpy.minimum((uv[:,0]*w).astype(numpy.int_),w-1)
+        y = numpy.minimum((uv[:,1]*h).astype(numpy.int_),h-1)
+        return texture[y,x]
+    x, y = uv[:,0]*w-.5, uv[:,1]*h-.5
+    x0, y0 = numpy.floor(x), numpy.floor(y)
+    fx, fy = (x-x0)[:,None], (y-y0)[:,None]
+    x0, y0 = x0.astype(numpy.int_), y0.astype(numpy.int_)
+    border = numpy.array((0.,0.,0.,1. if opaque else 0.))
+    def texel(x,y):
+        # GL_CLAMP filters against the black border at the edges, which is
+        # transparent unless the texture has no alpha, where alpha reads as 1
+        inside = ((x >= 0) & (x < w) & (y >= 0) & (y < h))[:,None]
+        return numpy.where(inside,texture[numpy.clip(y,0,h-1),numpy.clip(x,0,w-1)],border)
+    return (texel(x0,y0)*(1-fx)+texel(x0+1,y0)*fx)*(1-fy) + \
+        (texel(x0,y0+1)*(1-fx)+texel(x0+1,y0+1)*fx)*fy
+
+def sample_mipmapped(levels,uv,lod,filtering,opaque=False):
+    """GL_LINEAR_MIPMAP_LINEAR lookup of uv (N,2) in the mip chain levels, at the level of
+    detail lod (N,) that GL computes (log2 of texels per pixel); GL_LINEAR where it is magnified"""
+    if (filtering == "nearest") or (len(levels) == 1):
+        return sample(levels[0],uv,filtering,opaque)
+    lod = numpy.clip(lod,0.,len(levels)-1)
+    lo = numpy.floor(lod).astype(numpy.int_)
+    f = (lod-lo)[:,None]
+    out = numpy.empty((len(uv),4))
+    for level in numpy.unique(lo).tolist():
+        sel = lo == level
+        texel = sample(levels[level],uv[sel],filtering,opaque)
+        if level+1 < len(levels):
+            texel = texel*(1.-f[sel])+sample(levels[level+1],uv[sel],filtering,opaque)*f[sel]
+        out[sel] = texel
+    return out
+
+class Renderer:
+    def __init__(self,mgr,w=200,h=200,filtering="bilinear",tile=32):
+        self.mgr = mgr
+        self.w, self.h = w, h
+        self.filtering = filtering
+        self.tile = tile
+        self.textures = {}
+        self.opaque = set()
+    def _load_textures(self):
+        pending = [filename for filename,name in self.mgr.textures.iteritems() if name not in self.textures]
+        for filename,texture in g3d.decode_textures(pending):
+            name = self.mgr.textures[filename]
+            if isinstance(texture,Exception):
+                print "Could not load texture",filename,"->",name
+                print texture
+                self.textures[name] = None
+                continue
+            # the same mip chain that g3d.upload_texture() gives GL
+            levels, w, h = [], texture.w, texture.h
+            for level in texture.levels:
+                pixels = numpy.frombuffer(level,dtype=numpy.uint8).reshape(h,w,-1)
+                if texture.opaque:
+                    pixels = numpy.dstack((pixels,numpy.full((h,w),255,dtype=numpy.uint8)))
+                levels.append(pixels.astype(numpy.float32)/255.)
+                w, h = max(w//2,1), max(h//2,1)
+            if texture.opaque:
+                self.opaque.add(name)
+            self.textures[name] = levels
+    def transform(self,model,pose):
+        """returns (rotation,scale,translation) such that eye = (rotation.dot(vertex+translation))*scale"""
+        x, y, z, s = model.scaling
+        return rotation(pose), s, numpy.array((x,y,z))
+    def begin(self,background):
+        self.colour = numpy.empty((self.h*self.w,4))
+        self.colour[:] = background
+        self.depth = numpy.ones(self.h*self.w)
+    def end(self):
+        """the framebuffer as (h,w,4) bytes, top row first like a PIL image"""
+        colour = numpy.round(numpy.clip(self.colour,0.,1.)*255.).astype(numpy.uint8)
+        return colour.reshape(self.h,self.w,4)[::-1]
+    def draw(self,model,frame,pose,background):
+        self.begin(background)
+        self.draw_model(model,frame,pose)
+        return self.end()
+    def draw_model(self,model,frame,pose):
+        self._load_textures()
+        R, s, T = self.transform(model,pose)
+        for mesh in model.meshes:
+            self.draw_mesh(mesh,frame,R,s,T)
+    def overdraw(self,model,frame,pose):
+        """for each mesh, the pixel of every fragment it rasterizes and whether
+        that fragment then passes the alpha test"""
+        self._load_textures()
+        R, s, T = self.transform(model,pose)
+        out = []
+        for mesh in model.meshes:
+            fragments = self.fragments(mesh,frame,R,s,T)
+            if fragments is None:
+                out.append((numpy.zeros(0,dtype=numpy.int_),numpy.zeros(0,dtype=bool)))
+            else:
+                out.append((fragments[1],self.shade(mesh,fragments)[:,3] > alpha_ref))
+        return out
+    def fragments(self,mesh,frame,R,s,T):
+        """rasterizes a mesh; returns (triangle,pixel,depth,barycentrics,corners,frame,rotation,
+        gradients) for the fragments, gradients being the barycentrics' (d/dx,d/dy)"""
+        w, h, tile = self.w, self.h, self.tile
+        f = frame % len(mesh.vertices)
+        eye = ((mesh.vertices[f]+T)*s).dot(R.T)
+        corners = mesh.indices.astype(numpy.int_)
+        x = (eye[corners,0]+1.)*(w/2.)
+        y = (eye[corners,1]+1.)*(h/2.)
+        z = (eye[corners,2]+1.)/2.
+        area = (x[:,1]-x[:,0])*(y[:,2]-y[:,0])-(x[:,2]-x[:,0])*(y[:,1]-y[:,0])
+        # glFrontFace(GL_CCW); single-sided meshes cull their back faces
+        keep = (area != 0) if mesh.twoSided else (area > 0)
+        keep &= (x.max(axis=1) >= 0) & (x.min(axis=1) < w) & (y.max(axis=1) >= 0) & (y.min(axis=1) < h)
+        tri = numpy.nonzero(keep)[0]
+        if not len(tri):
+            return None
+        x, y, z, area = x[tri], y[tri], z[tri], area[tri]
+        # barycentric l[i] = A[i]*px + B[i]*py + C[i]
+        j, k = (1,2,0), (2,0,1)
+        A = (y[:,j]-y[:,k])/area[:,None]
+        B = (x[:,k]-x[:,j])/area[:,None]
+        C = (x[:,j]*y[:,k]-x[:,k]*y[:,j])/area[:,None]
+        # bin triangles into the tiles their bounds overlap
+        tx0 = numpy.clip(numpy.floor(x.min(axis=1)-.5),0,w-1).astype(numpy.int_)//tile
+        tx1 = numpy.clip(numpy.ceil(x.max(axis=1)-.5),0,w-1).astype(numpy.int_)//tile
+        ty0 = numpy.clip(numpy.floor(y.min(axis=1)-.5),0,h-1).astype(numpy.int_)//tile
+        ty1 = numpy.clip(numpy.ceil(y.max(axis=1)-.5),0,h-1).astype(numpy.int_)//tile
+        out = []
+        for ty in xrange(ty0.min(),ty1.max()+1):
+            for tx in xrange(tx0.min(),tx1.max()+1):
+                sel = numpy.nonzero((tx0 <= tx) & (tx1 >= tx) & (ty0 <= ty) & (ty1 >= ty))[0]
+                if not len(sel):
+                    continue
+                px, py = numpy.meshgrid(numpy.arange(tx*tile,min((tx+1)*tile,w)),
+                    numpy.arange(ty*tile,min((ty+1)*tile,h)))
+                px, py = px.ravel(), py.ravel()
+                cx, cy = px+.5, py+.5 # pixel centres
+                l = A[sel,:,None]*cx+B[sel,:,None]*cy+C[sel,:,None] # (K,3,P)
+                inside = (l >= 0.).all(axis=1)
+                depth = (l*z[sel,:,None]).sum(axis=1)
+                inside &= (depth >= 0.) & (depth <= 1.)
+                kk, pp = numpy.nonzero(inside)
+                if len(kk):
+                    out.append((sel[kk],py[pp]*w+px[pp],depth[kk,pp],l[kk,:,pp]))
+        if not out:
+            return None
+        triangles, pixels, depth, l = [numpy.concatenate(a) for a in zip(*out)]
+        return tri[triangles], pixels, depth, l, corners, f, R, numpy.dstack((A,B))[triangles]
+    def shade(self,mesh,fragments):
+        """the fixed-function colour of each fragment, as (N,4) floats"""
+        triangles, pixels, depth, l, corners, f, R, gradients = fragments
+        # per-vertex lighting, with GL_NORMALIZE and GL_COLOR_MATERIAL
+        normals = mesh.normals[f].dot(R.T)
+        normals /= numpy.maximum(numpy.sqrt((normals*normals).sum(axis=1)),1e-12)[:,None]
+        base = numpy.array((1.,0.,0.,1.) if mesh.customColor else (1.,1.,1.,1.))
+        lit = numpy.empty((len(normals),4))
+        lit[:,:3] = base[:3]*(scene_ambient+light_ambient+ \
+            light_diffuse*numpy.maximum(normals.dot(light_dir),0.))[:,None]
+        lit[:,3] = base[3]
+        lit = numpy.clip(lit,0.,1.)
+        vertices = corners[triangles] # (N,3)
+        colour = (lit[vertices]*l[:,:,None]).sum(axis=1)
+        levels = self.textures.get(mesh.texture) if mesh.txCoords is not None else None
+        if levels is not None:
+            uv = mesh.txCoords[0][vertices] # (N,3,2)
+            # texels per pixel along x and y pick the mip level, as GL does
+            h, w = levels[0].shape[:2]
+            duv = numpy.matmul(uv.transpose(0,2,1),gradients)*numpy.array((w,h))[None,:,None] # (N,2,2)
+            rho = numpy.sqrt((duv*duv).sum(axis=1)).max(axis=1)
+            lod = numpy.log2(numpy.maximum(rho,1e-12))
+            uv = (uv*l[:,:,None]).sum(axis=1)
+            texel = sample_mipmapped(levels,uv,lod,self.filtering,mesh.texture in self.opaque)
+            if mesh.customColor: # GL_DECAL
+                colour[:,:3] = colour[:,:3]*(1.-texel[:,3:])+texel[:,:3]*texel[:,3:]
+            else: # GL_BLEND, with the default (black) environment colour
+                colour[:,:3] *= 1.-texel[:,:3]
+                colour[:,3] *= texel[:,3]
+        return colour
+    def draw_mesh(self,mesh,frame,R,s,T):
+        fragments = self.fragments(mesh,frame,R,s,T)
+        if fragments is None:
+            return
+        triangles, pixels, depth = fragments[:3]
+        colour = self.shade(mesh,fragments)
+        passed = colour[:,3] > alpha_ref
+        self.resolve(triangles[passed],pixels[passed],depth[passed],colour[passed])
+    def resolve(self,triangles,pixels,depth,colour):
+        """GL_LESS depth test and SRC_ALPHA,ONE_MINUS_SRC_ALPHA blending in draw order"""
+        if not len(pixels):
+            return
+        order = numpy.lexsort((triangles,pixels))
+        pixels, depth, colour = pixels[order], depth[order], colour[order]
+        # rank of each fragment amongst those hitting the same pixel
+        first = numpy.concatenate(([True],pixels[1:] != pixels[:-1]))
+        starts = numpy.nonzero(first)[0]
+        rank = numpy.arange(len(pixels))-numpy.repeat(starts,numpy.diff(numpy.append(starts,len(pixels))))
+        for r in xrange(rank.max()+1):
+            layer = rank == r
+            p, z, c = pixels[layer], depth[layer], colour[layer]
+            passed = z < self.depth[p]
+            p, z, c = p[passed], z[passed], c[passed]
+            self.depth[p] = z
+            a = c[:,3:]
+            self.colour[p,:3] = c[:,:3]*a+self.colour[p,:3]*(1.-a)
+            self.colour[p,3] = c[:,3]*c[:,3]+self.colour[p,3]*(1.-c[:,3])
@@ -2,6 +2,9 @@
 
 use_shaders = True
 use_vbros = True
+rigid_tolerance = 0.00001 # how far distances may drift between frames and still be rigid, as a share of the model's size
+rigid_splits = 64 # most pieces a connected component is split into; then each triangle left is a piece
+overdraw_flag = .25 # two-sided meshes making this share of a model's fragments are flagged
 
 import struct, os, sys, time, numpy, math, traceback, ctypes
 
@@ -31,6 +34,12 @@ class BinaryStream:
         return self.unpack("<I")
     def float32(self):
         return self.unpack("f") 
+    def array(self,dtype,count):
+        dtype = numpy.dtype(dtype)
+        data = self.read(dtype.itemsize*count)
+        if len(data) != dtype.itemsize*count:
+            raise Exception("%s is truncated"%self.filename)
+        return numpy.frombuffer(data,dtype=dtype)
         
 class Bounds:
     def __init__(self):
@@ -61,6 +70,34 @@ class Bounds:
         z = -self.bounds[2]-(d/2.)
         return (x,y,z)
 
+def rigid_fit(rest,posed,group,count):
+    """least-squares (Kabsch) rotation and translation of each group of points in each frame:
+    rest (N,3) and posed (F,N,3) are the points, group (N,) labels them 0..count-1;
+    returns R (F,count,3,3) and t (F,count,3) such that posed ~= R.dot(rest)+t"""
+    frames = len(posed)
+    n = numpy.maximum(numpy.bincount(group,minlength=count),1).astype(numpy.float64)
+    def centres(points):
+        return numpy.dstack([numpy.bincount(group,points[:,k],count) for k in xrange(3)])[0]/n[:,None]
+    cp = centres(rest)
+    cq = numpy.array([centres(frame) for frame in posed])
+    p = rest-cp[group]
+    q = posed-cq[:,group]
+    # H[f,g] = sum of outer(p,q) over the points of group g
+    H = numpy.zeros((frames*count,3,3))
+    cells = (numpy.arange(frames)[:,None]*count+group).ravel()
+    for j in xrange(3):
+        for k in xrange(3):
+            H[:,j,k] = numpy.bincount(cells,(p[None,:,j]*q[:,:,k]).ravel(),frames*count)
+    U, S, Vt = numpy.linalg.svd(H)
+    V, Ut = Vt.transpose(0,2,1), U.transpose(0,2,1)
+    # no reflections
+    d = numpy.sign(numpy.linalg.det(numpy.matmul(V,Ut)))
+    d[d == 0] = 1
+    V[:,:,2] *= d[:,None]
+    R = numpy.matmul(V,Ut).reshape(frames,count,3,3)
+    t = cq-numpy.matmul(R,cp[None,:,:,None])[...,0]
+    return R, t
+
 def repack(array):
     h,w = array.shape
     new = numpy.zeros(w*h,dtype=array.dtype)
@@ -73,6 +110,7 @@ class Mesh(object):
         self.g3d = g3d
         self.txCoords = None
         self.texture = None
+        self.texture_names = []
         self.bounds = []
         self.in_vertices = 0
         self.in_indices = 0
@@ -80,89 +118,168 @@ class Mesh(object):
         self.out_indices = 0
         self.out_matrices = 0
         self.vbos = None
+        self.twoSided = self.customColor = False
     def _load_vn(self,f,frameCount,vertexCount):
-        self.vertices = []
-        for i in xrange(frameCount):
-            vertices = numpy.zeros((vertexCount,3),dtype=numpy.float32)
+        self.vertices = f.array("<f4",frameCount*vertexCount*3).reshape(frameCount,vertexCount,3)
+        for vertices in self.vertices:
             bounds = Bounds()
-            for v in xrange(vertexCount):
-                pt = (f.float32(),f.float32(),f.float32())
-                vertices[v] = pt
-                bounds.add_xyz(*pt)
-            self.vertices.append(vertices)
+            if vertexCount:
+                bounds.bounds = vertices.min(axis=0).tolist()+vertices.max(axis=0).tolist()
             self.bounds.append(bounds)
-        self.normals = []
-        for i in xrange(frameCount):
-            normals = numpy.zeros((vertexCount,3),dtype=numpy.float32)
-            for n in xrange(vertexCount):
-                pt = (f.float32(),f.float32(),f.float32())
-                normals[n] = pt
-            self.normals.append(normals)
+        self.normals = f.array("<f4",frameCount*vertexCount*3).reshape(frameCount,vertexCount,3)
         self.in_vertices = (frameCount*vertexCount)
     def _load_t(self,f,frameCount,vertexCount):
-        self.txCoords = numpy.zeros((frameCount,vertexCount,2),dtype=numpy.float32)
-        for i in xrange(frameCount):
-            for v in xrange(vertexCount):
-                pt = (f.float32(),f.float32())
-                self.txCoords[i,v] = pt
+        self.txCoords = f.array("<f4",frameCount*vertexCount*2).reshape(frameCount,vertexCount,2)
     def _load_i(self,f,indexCount):
         assert indexCount % 3 == 0, "incomplete triangles (%s)"%indexCount
-        self.indices = numpy.zeros((indexCount/3,3),dtype=numpy.uint32)
-        for i in xrange(indexCount/3):
-            self.indices[i] = (f.uint32(),f.uint32(),f.uint32())
+        self.indices = f.array("<u4",indexCount).reshape(-1,3)
         self.in_indices = indexCount
     def identify_immutable(self,verbosity):
+        """groups triangles into rigid groups, which could each be drawn with one matrix
+        per frame.  Triangles whose edges keep their lengths are joined by union-find over
+        the vertices they share; each component is split until every vertex keeps its
+        distance to three anchors in every frame.  Pieces are then sorted by their fitted
+        motions, and each is merged into the first nearby piece whose anchors it keeps its
+        distances to"""
         self.analysis = [None for v in self.vertices]
-        #return
-        def dist(a,b):
-            sqrd = (a[0]-b[0])**2 + \
-                (a[1]-b[1])**2 + \
-                (a[2]-b[2])**2
-            if sqrd > 0:
-                return math.sqrt(sqrd)
-            return 0
-        def feq(a,b):
-            return abs(a-b) < 0.000001
-        def triangle_eq(a,b,c,d):
-            for i in xrange(3):
-                if not feq(dist(a[i],b[i]),dist(c[i],d[i])):
-                    return False
-            return True
         if verbosity > 1: print "Analyse",self.__class__.__name__,len(self.vertices),len(self.vertices[0]),len(self.indices),
+        frames = numpy.array(self.vertices,dtype=numpy.float64)
+        triangles = self.indices.astype(numpy.int_)
+        self.group = numpy.zeros(len(triangles),dtype=numpy.int_)
+        # float32 coordinates are only so precise, so how far is rigid depends on the model's
+        # size, or on how far from the origin it is, whichever is larger
+        epsilon = rigid_tolerance*(max(self.g3d.extent,numpy.abs(frames).max() if frames.size else 0.) or 1.)
+        def constant(a,b):
+            # whether the distances between vertices a and b are the same in every frame
+            d = numpy.sqrt(((frames[:,a]-frames[:,b])**2).sum(axis=-1))
+            return (numpy.abs(d-d[:1]) < epsilon).all(axis=0)
+        rigid = constant(triangles[:,0],triangles[:,1]) & \
+            constant(triangles[:,1],triangles[:,2]) & \
+            constant(triangles[:,2],triangles[:,0])
+        parent = range(len(self.vertices[0]))
+        def find(v):
+            while parent[v] != v:
+                parent[v] = parent[parent[v]]
+                v = parent[v]
+            return v
+        for a,b,c in triangles[rigid].tolist():
+            a = find(a)
+            parent[find(b)] = a
+            parent[find(c)] = a
+        candidates = numpy.nonzero(rigid)[0]
+        roots = numpy.array([find(v) for v in triangles[candidates,0].tolist()],dtype=numpy.int_)
+        order = numpy.argsort(roots,kind="mergesort")
+        candidates, roots = candidates[order], roots[order]
+        # the largest triangle of a piece makes the best anchors
+        v0 = frames[0]
+        area = numpy.cross(v0[triangles[:,1]]-v0[triangles[:,0]],v0[triangles[:,2]]-v0[triangles[:,0]])
+        area = (area*area).sum(axis=1)
+        pieces, anchors = [], []
+        for component in numpy.split(candidates,numpy.nonzero(numpy.diff(roots))[0]+1):
+            pending = component
+            for split in xrange(rigid_splits):
+                if not len(pending):
+                    break
+                anchor = triangles[pending[numpy.argmax(area[pending])]]
+                vertices, inverse = numpy.unique(triangles[pending],return_inverse=True)
+                ok = numpy.ones(len(vertices),dtype=bool)
+                for a in anchor:
+                    ok &= constant(vertices,numpy.repeat(a,len(vertices)))
+                ok = ok[inverse].reshape(-1,3).all(axis=1)
+                pieces.append(pending[ok])
+                anchors.append(anchor)
+                pending = pending[~ok]
+            # every triangle here is rigid, so is a piece of its own
+            pieces += [pending[i:i+1] for i in xrange(len(pending))]
+            anchors += list(triangles[pending])
+        # pieces that aren't connected may still move together.  Sorted by a digest of their
+        # fitted motions, those that might are close together; constant() then decides
+        leaders, members = [], []
+        if pieces:
+            anchors = numpy.array(anchors)
+            R, t = rigid_fit(v0[anchors.ravel()],frames[:,anchors.ravel()],
+                numpy.repeat(numpy.arange(len(pieces)),3),len(pieces))
+            size = max(numpy.abs(v0).max(),epsilon)
+            motion = numpy.concatenate((R.reshape(len(frames),len(pieces),9),t/size),axis=2)
+            motion = motion.transpose(1,0,2).reshape(len(pieces),-1)
+            digest = motion.dot(numpy.random.RandomState(0).uniform(-1.,1.,motion.shape[1]))
+            # how far apart the digests of pieces that move the same way can be; wider is just slower
+            window = .01*motion.shape[1]
+            first = 0
+            for i in numpy.argsort(digest,kind="mergesort").tolist():
+                while (first < len(leaders)) and (digest[leaders[first]] < digest[i]-window):
+                    first += 1
+                candidates = numpy.array(leaders[first:],dtype=numpy.int_)
+                ok = numpy.ones(len(candidates),dtype=bool)
+                for a in anchors[i]:
+                    for j in xrange(3):
+                        ok &= constant(anchors[candidates,j],numpy.repeat(a,len(candidates)))
+                if ok.any():
+                    members[first+int(numpy.argmax(ok))].append(i)
+                else:
+                    leaders.append(i)
+                    members.append([i])
         num_groups = 0
-        ungrouped = 0
-        v0 = self.vertices[0]
-        self.group = numpy.zeros(len(self.indices),dtype=numpy.int_)
-        for i,triangle1 in enumerate(self.indices):
-            if self.group[i] > 0:
-                continue
-            grouped = False
-            a = (v0[triangle1[0]],v0[triangle1[1]],v0[triangle1[2]])
-            for j in xrange(i+1,len(self.indices)):
-                if self.group[j] > 0:
-                    continue
-                triangle2 = self.indices[j]
-                b = (v0[triangle2[0]],v0[triangle2[1]],v0[triangle2[2]])
-                eq = True
-                for vn in self.vertices[1:]:
-                    c = (vn[triangle1[0]],vn[triangle1[1]],vn[triangle1[2]])
-                    d = (vn[triangle2[0]],vn[triangle2[1]],vn[triangle2[2]])
-                    if not triangle_eq(a,b,c,d):
-                        eq = False
-                        break
-                if not eq:
-                    continue
-                if not grouped:
-                    num_groups += 1
-                    self.group[i] = num_groups
-                    grouped = True
-                self.group[j] = num_groups
-            ungrouped += 1 if not grouped else 0
+        for bucket in members:
+            bucket = numpy.concatenate([pieces[i] for i in bucket])
+            if len(bucket) > 1:
+                num_groups += 1
+                self.group[bucket] = num_groups
+        ungrouped = int((self.group == 0).sum())
         print "%s groups%s"%(num_groups,", %s ungrouped"%ungrouped if (ungrouped>0) else ""),
         print "immutable" if len(self.vertices)==1 else "mutable" if ungrouped else "IMMUTABLE"
         self.out_vertices = len(self.vertices[0]) + (ungrouped * (len(self.vertices)-1))
         self.out_matrices = (len(self.vertices)-1) * num_groups
         self.out_indices = self.in_indices
+    def fit_rigid(self,verbosity):
+        """solves the rotation and translation of every rigid group in every frame;
+        self.rigid holds the rest pose (frame 0) of each (vertex,group) pair, the
+        (F,G,4,4) matrices and the largest distance a fitted vertex is off by"""
+        frames = numpy.array(self.vertices,dtype=numpy.float64)
+        frame_count, vertex_count = frames.shape[:2]
+        triangles = self.indices.astype(numpy.int_)
+        grouped = self.group > 0
+        num_groups = int(self.group.max()) if len(self.group) else 0
+        # a vertex shared by two groups is in the rest pose twice
+        pairs = numpy.unique((self.group[grouped][:,None]*vertex_count+triangles[grouped]).ravel())
+        vertices, groups = pairs % vertex_count, pairs//vertex_count-1
+        matrices = numpy.zeros((frame_count,num_groups,4,4),dtype=numpy.float32)
+        error = 0.
+        if num_groups:
+            rest = frames[0,vertices]
+            R, t = rigid_fit(rest,frames[:,vertices],groups,num_groups)
+            fitted = numpy.matmul(R[:,groups],rest[:,:,None])[...,0]+t[:,groups]
+            error = float(numpy.sqrt(((fitted-frames[:,vertices])**2).sum(axis=-1)).max())
+            matrices[:,:,:3,:3] = R
+            matrices[:,:,:3,3] = t
+            matrices[:,:,3,3] = 1.
+        # the vertices of ungrouped triangles still need every frame
+        loose = len(numpy.unique(triangles[~grouped]))
+        self.rigid = {"vertex":vertices.astype(numpy.uint32),"group":groups.astype(numpy.uint32),
+            "rest":self.vertices[0][vertices],"rest_normals":self.normals[0][vertices],
+            "matrices":matrices,"triangle_group":self.group.astype(numpy.uint32),"error":error}
+        self.rigid_bytes = (len(vertices)+loose*frame_count)*4*3*2 + matrices.nbytes
+        if verbosity > 1:
+            print "rigid fit: %d groups, max error %g, %s -> %s"%(num_groups,error,
+                fmt_bytes(frame_count*vertex_count*4*3*2),fmt_bytes(self.rigid_bytes))
+    def stats(self):
+        """the figures batch_stats() records for this mesh; call after analysis"""
+        frame_count, vertex_count = self.vertices.shape[:2]
+        columns = [self.vertices,self.normals]
+        if self.txCoords is not None:
+            columns.append(self.txCoords)
+        # a duplicate vertex matches an earlier one in every frame
+        rows = numpy.hstack([c.transpose(1,0,2).reshape(vertex_count,-1) for c in columns])
+        distinct = len(numpy.unique(rows,axis=0)) if vertex_count else 0
+        return {"frames":frame_count,"vertices":vertex_count,"indices":self.in_indices,
+            "two_sided":self.twoSided,"custom_color":self.customColor,
+            "textures":self.texture_names,"bounds":[b.bounds for b in self.bounds],
+            "bytes":sum(c.nbytes for c in columns)+self.indices.nbytes,
+            "duplicate_vertices":vertex_count-distinct,
+            "unused_vertices":vertex_count-len(numpy.unique(self.indices)),
+            "rigid_groups":int(self.group.max()) if len(self.group) else 0,
+            "ungrouped_triangles":int((self.group == 0).sum()),
+            "rigid_error":self.rigid["error"],"rigid_bytes":self.rigid_bytes}
     def interop(self,now):
         i = (now*self.g3d.mgr.render_speed)%len(self.vertices)
         p = int(i)
@@ -278,7 +395,10 @@ class Mesh3(Mesh):
         indexCount = f.uint32()
         properties = f.uint32()
         texture = f.text64()
+        self.customColor = (properties & 4) == 4
+        self.twoSided = (properties & 2) == 2
         if 0 == (properties & 1):
+            self.texture_names.append(texture)
             self.texture = g3d.assign_texture(texture)
             bumpmap = texture[:-4]+"_normal"+texture[-4:]
             if os.path.isfile(bumpmap):
@@ -302,10 +422,13 @@ class Mesh4(Mesh):
         indexCount = f.uint32()
         f.read(8*4)
         self.properties = properties = f.uint32()
+        self.customColor = (properties & 1) == 1
+        self.twoSided = (properties & 2) == 2
         self.textures = textures = f.uint32()
         for t in xrange(5):
             if ((1 << t) & textures) != 0:
-                texture = g3d.assign_texture(f.text64())
+                self.texture_names.append(f.text64())
+                texture = g3d.assign_texture(self.texture_names[-1])
                 if t == 0:
                     self.texture = texture
                 elif t == 2:
@@ -344,12 +467,14 @@ class G3D:
             for frame in mesh.bounds:
                 bounds.add_bounds(frame)
         x,y,z = bounds.centre()
-        s = 1.8/max(*bounds.size())
+        self.extent = max(*bounds.size())
+        s = 1.8/self.extent
         self.scaling = (x,y,z,s)
     def analyse(self,verbosity):
         if verbosity > 0: print "Analysing G3D",self.filename
         for mesh in self.meshes:
             mesh.identify_immutable(verbosity)
+            mesh.fit_rigid(verbosity)
     def assign_texture(self,texture):
         while texture.startswith("\\") or texture.startswith("/"):
             texture = texture[1:]
@@ -388,6 +513,7 @@ class Manager:
         filename = os.path.relpath(filename,self.base_folder)
         if filename not in self.models:
             self.models[filename] = G3D(self,filename)
+        return self.models[filename]
     def analyse(self,verbosity=sys.maxint):
         for model in self.models.values():
             model.analyse(verbosity)
@@ -403,6 +529,21 @@ class Manager:
         print indices,"indices out","(%s)"%fmt_bytes(indices*4)
         matrices = sum(sum(mesh.out_matrices for mesh in model.meshes) for model in self.models.values())
         print matrices,"matrices out","(%s)"%fmt_bytes(matrices*4*4*4)
+        print "=== Rigid fit ==="
+        rigid = sum(sum(mesh.rigid_bytes for mesh in model.meshes) for model in self.models.values())
+        print "rest pose, loose vertices and matrices","(%s)"%fmt_bytes(rigid)
+        error = max([mesh.rigid["error"] for model in self.models.values() for mesh in model.meshes] or [0])
+        print "max reconstruction error",error
+    def export_rigid(self,filename):
+        """saves the rigid fit of every mesh of every analysed model as one .npz,
+        with arrays named model:mesh:array"""
+        arrays = {}
+        for name,model in self.models.iteritems():
+            for i,mesh in enumerate(model.meshes):
+                for key,value in mesh.rigid.iteritems():
+                    arrays["%s:%d:%s"%(name.replace("\\","/"),i,key)] = numpy.asarray(value)
+        numpy.savez_compressed(filename,**arrays)
+        print "Rigid fit written to",filename
     def assign_texture(self,texture):
         if texture not in self.textures:
             v = self.assign_object()
@@ -427,34 +568,170 @@ class Manager:
     def resolve_mesh(self,v):
         return self.mesh_reverse[v]
     def load_textures_gl(self):
-        import Image
-        for filename,texture in self.textures.iteritems():
-            try:
-                image = Image.open(filename)
-                w, h = image.size
-                try:
-                    image = image.tostring("raw","RGBA",0,-1)
-                    mode = GL_RGBA
-                except:
-                    image = image.tostring("raw","RGB",0,-1)
-                    mode = GL_RGB
-                    self.opaque_textures.add(texture)
-                glPixelStorei(GL_UNPACK_ALIGNMENT,1)
-                glBindTexture(GL_TEXTURE_2D,texture)
-                glTexParameterf(GL_TEXTURE_2D,GL_TEXTURE_WRAP_S,GL_CLAMP)
-                glTexParameterf(GL_TEXTURE_2D,GL_TEXTURE_WRAP_T,GL_CLAMP)
-                glTexParameterf(GL_TEXTURE_2D,GL_TEXTURE_MAG_FILTER,GL_LINEAR)
-                glTexParameterf(GL_TEXTURE_2D,GL_TEXTURE_MIN_FILTER,GL_LINEAR)
-                glTexImage2D(GL_TEXTURE_2D,0,mode,w,h,0,mode,GL_UNSIGNED_BYTE,image)
-            except Exception,e:
-                print "Could not load texture",filename,"->",texture
-                print e
+        from OpenGL import GL
+        import g3d
+        aliases = g3d.load_textures_gl(GL,self.textures,self.opaque_textures)
+        g3d.alias_textures(self.models.values(),aliases)
+        
+def find_models(paths):
+    filenames = []
+    for filename in paths:
+        filename = os.path.abspath(filename)
+        if os.path.isfile(filename):
+            filenames.append(filename)
+        else:
+            for f in os.walk(filename):
+                path = f[0] 
+                for f in f[2]:
+                    if os.path.splitext(f)[1] == ".g3d":
+                        filenames.append(os.path.join(path,f))
+    return filenames
+    
+def faction_unit(filename):
+    """the faction and unit a model belongs to, going by the techtree folder layout"""
+    parts = os.path.abspath(filename).replace("\\","/").split("/")[:-1]
+    def after(folder):
+        return parts[parts.index(folder)+1] if folder in parts[:-1] else None
+    return after("factions"), after("units")
+    
+stats_fields = ("model","faction","unit","mesh","version","frames","vertices","indices","textures",
+    "two_sided","custom_color","bounds","bytes","duplicate_vertices","unused_vertices","rigid_groups",
+    "ungrouped_triangles","rigid_error","rigid_bytes","depth_complexity","peak_depth","fill_share",
+    "alpha_discarded","overdraw_flagged","error")
+stats_totals = ("meshes","vertices","indices","bytes","duplicate_vertices","unused_vertices","rigid_bytes")
+    
+def overdraw(filename,frames=4,w=200,h=200,pose=(-20,130,0)):
+    """rasterizes a model in software as g3d_thumb frames it, counting the fragments each
+    mesh generates whether or not the alpha test discards them, over up to frames frames
+    spread through the animation; returns the model's (depth complexity, peak depth) and,
+    for each mesh, its depth complexity (fragments per pixel it covers), peak depth, share
+    of the model's fragments and the share of its fragments the alpha test discards"""
+    import g3d, g3d_raster
+    mgr = g3d.Manager()
+    model = mgr.load_model(filename)
+    renderer = g3d_raster.Renderer(mgr,w,h)
+    count = max(min(frames,model.frame_count),1)
+    fragments = numpy.zeros(len(model.meshes))
+    discarded = numpy.zeros(len(model.meshes))
+    covered = numpy.zeros(len(model.meshes))
+    peak = numpy.zeros(len(model.meshes),dtype=numpy.int_)
+    model_fragments = model_covered = model_peak = 0
+    for frame in sorted(set(i*max(model.frame_count,1)//count for i in xrange(count))):
+        total = numpy.zeros(w*h,dtype=numpy.int_)
+        for i,(pixels,passed) in enumerate(renderer.overdraw(model,frame,pose)):
+            depth = numpy.bincount(pixels,minlength=w*h)
+            total += depth
+            fragments[i] += len(pixels)
+            discarded[i] += len(pixels)-passed.sum()
+            covered[i] += (depth > 0).sum()
+            peak[i] = max(peak[i],depth.max())
+        model_fragments += total.sum()
+        model_covered += (total > 0).sum()
+        model_peak = max(model_peak,total.max())
+    meshes = []
+    for i,mesh in enumerate(model.meshes):
+        share = fragments[i]/max(model_fragments,1)
+        meshes.append({"depth_complexity":fragments[i]/max(covered[i],1),"peak_depth":int(peak[i]),
+            "fill_share":share,"alpha_discarded":discarded[i]/max(fragments[i],1),
+            "overdraw_flagged":bool(mesh.twoSided and (share >= overdraw_flag))})
+    return (float(model_fragments)/max(model_covered,1),int(model_peak)), meshes
+    
+def print_overdraw(model):
+    (depth_complexity,peak_depth), fills = overdraw(model.filename)
+    print "Overdraw of %s: depth complexity %.2f, peak %d"%(model.filename,depth_complexity,peak_depth)
+    for i,(mesh,fill) in enumerate(zip(model.meshes,fills)):
+        print "\t%d %-24s %5.2f avg %3d peak %3.0f%% of fragments %3.0f%% discarded%s%s"%(i,
+            getattr(mesh,"name",""),fill["depth_complexity"],fill["peak_depth"],fill["fill_share"]*100.,
+            fill["alpha_discarded"]*100.," two-sided" if mesh.twoSided else "",
+            " <<< costly" if fill["overdraw_flagged"] else "")
+    
+def model_stats(filename,with_overdraw=False):
+    """analyses a model and returns a record for each of its meshes, or one with an error;
+    a model without meshes gets one record without a mesh, so it is still counted"""
+    faction, unit = faction_unit(filename)
+    try:
+        model = Manager().load_model(filename)
+        model.analyse(0)
+        fills = overdraw(filename)[1] if with_overdraw else [{} for mesh in model.meshes]
+    except Exception,e:
+        return [{"model":filename,"faction":faction,"unit":unit,"error":str(e)}]
+    records = []
+    for i,(mesh,fill) in enumerate(zip(model.meshes,fills)):
+        record = mesh.stats()
+        record.update(fill)
+        record.update(model=filename,faction=faction,unit=unit,mesh=i,version=model.ver)
+        records.append(record)
+    if not records:
+        records.append({"model":filename,"faction":faction,"unit":unit,"version":model.ver})
+    return records
+    
+def batch_stats(filenames,out,jobs=None,with_overdraw=False):
+    """analyses models in a worker pool, streaming a record per mesh to out as JSON lines
+    (or CSV, if out ends .csv) as each model is done; the totals per faction and unit
+    are printed and written to out's .summary.json"""
+    import multiprocessing, json, csv
+    f = open(out,"wb")
+    if os.path.splitext(out)[1].lower() == ".csv":
+        writer = csv.DictWriter(f,stats_fields)
+        writer.writeheader()
+        def write(record):
+            writer.writerow(dict((key,json.dumps(value) if isinstance(value,list) else value)
+                for key,value in record.iteritems()))
+    else:
+        def write(record):
+            f.write(json.dumps(record,sort_keys=True)+"\n")
+    totals = {}
+    pool = multiprocessing.Pool(jobs)
+    try:
+        import functools
+        for records in pool.imap_unordered(functools.partial(model_stats,with_overdraw=with_overdraw),filenames):
+            total = totals.setdefault((records[0]["faction"],records[0]["unit"]),
+                dict([("models",0),("errors",0)]+[(key,0) for key in stats_totals]))
+            total["models"] += 1
+            for record in records:
+                write(record)
+                if "error" in record:
+                    total["errors"] += 1
+                    continue
+                if "mesh" not in record:
+                    continue
+                total["meshes"] += 1
+                total["vertices"] += record["frames"]*record["vertices"]
+                for key in stats_totals[2:]:
+                    total[key] += record[key]
+            f.flush()
+    finally:
+        pool.close()
+        pool.join()
+        f.close()
+    # each faction's total is listed with unit "*"
+    for (faction,unit),total in totals.items():
+        if unit is None: continue
+        faction_total = totals.setdefault((faction,"*"),dict((key,0) for key in total))
+        for key,value in total.iteritems():
+            faction_total[key] += value
+    summary = []
+    print "%-20s %-20s %6s %6s %10s %10s %10s"%("faction","unit","models","meshes","vertices","bytes","rigid")
+    for (faction,unit),total in sorted(totals.items(),key=lambda (key,total): (str(key[0]),str(key[1]))):
+        print "%-20s %-20s %6d %6d %10d %10s %10s"%(faction,unit,total["models"],total["meshes"],
+            total["vertices"],fmt_bytes(total["bytes"]),fmt_bytes(total["rigid_bytes"]))
+        total.update(faction=faction,unit=unit)
+        summary.append(total)
+    json.dump(summary,open(os.path.splitext(out)[0]+".summary.json","w"),indent=1,sort_keys=True)
         
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        sys.exit("Usage: python g3d_stats.py [model.g3d] {model2.g3d} ... {modelN.g3d}")
+    import getopt
+    opts, args = getopt.getopt(sys.argv[1:],"",["rigid=","batch=","jobs=","overdraw"])
+    opts = dict(opts)
+    if len(args) < 1:
+        sys.exit("""Usage: python g3d_stats.py {options} [model.g3d] {model2.g3d} ... {modelN.g3d}
+options:
+    --rigid=out.npz analyse, and save each rigid group's matrices and the rest pose
+    --batch=out.jsonl stream statistics per mesh (CSV if out ends .csv) and totals per unit
+    --jobs=N worker processes for --batch (default is one per core)
+    --overdraw rasterize each model to estimate its fill cost""")
 
-    if (len(sys.argv) == 2) and os.path.isfile(sys.argv[1]):        
+    if (len(args) == 1) and os.path.isfile(args[0]) and not opts:
         try:
             import pygtk; pygtk.require('2.0')
             import gtk, gtk.gdk as gdk, gtk.gtkgl as gtkgl, gtk.gdkgl as gdkgl, gobject
@@ -593,7 +870,7 @@ if __name__ == "__main__":
                     self.selection = self.resolve_mesh(nearest[0])
                         
             scene = Scene()
-            scene.load_model(sys.argv[1])
+            scene.load_model(args[0])
             scene.analyse()
         
             gtk.gdk.threads_init()
@@ -611,18 +888,18 @@ if __name__ == "__main__":
             import traceback; traceback.print_exc()
             print "Could not display 3D using OpenGL and GTK with ZPR"
            
+    if "--batch" in opts:
+        batch_stats(find_models(args),opts["--batch"],int(opts["--jobs"]) if "--jobs" in opts else None,
+            "--overdraw" in opts)
+        sys.exit(0)
+           
     mgr = Manager()
-    models = {}
-    for filename in sys.argv[1:]:
-        filename = os.path.abspath(filename)
-        if os.path.isfile(filename):
-            mgr.load_model(filename)
-        else:
-            for f in os.walk(filename):
-                path = f[0] 
-                for f in f[2]:
-                    if os.path.splitext(f)[1] == ".g3d":
-                        filename = os.path.join(path,f)
-                        mgr.load_model(filename)
-    #mgr.analyse()
+    for filename in find_models(args):
+        mgr.load_model(filename)
+    mgr.analyse()
+    if "--rigid" in opts:
+        mgr.export_rigid(opts["--rigid"])
+    if "--overdraw" in opts:
+        for model in mgr.models.values():
+            print_overdraw(model)
 
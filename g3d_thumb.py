@@ -1,55 +1,360 @@
 #!/usr/bin/env python
 
-import sys, Image
-from OpenGL.GLUT import *
-from OpenGL.GL import *
-import g3d
+import sys, os, ctypes, struct, zlib, math, json
+import numpy
+try:
+    import Image
+except ImportError:
+    from PIL import Image
+if sys.platform.startswith("linux") and ("PYOPENGL_PLATFORM" not in os.environ) and \
+    not os.environ.get("DISPLAY"):
+    os.environ["PYOPENGL_PLATFORM"] = "egl" # no X server, so render offscreen
+try:
+    from OpenGL.GL import *
+except Exception:
+    pass # without PyOpenGL, only software rendering (-s) is available
+try:
+    from OpenGL.GLUT import *
+except Exception:
+    pass # GLUT isn't available on the offscreen platforms
+import g3d, g3d_raster
+from g3d import cache_key
 
 default_w,default_h = 200,200 # size in pixels of window (and capture output)
 default_pose = (-20,130,0) # angle on x,y,z respectively
 default_background = (1.,.9,.9,1.) # rgba 1=0xff
 default_out_path = "." # folder (and file prefix) where the frames should be saved to
+default_delay = 100 # milliseconds per frame
+default_yaws = 8 # impostor views around the model
+default_pitches = (-30,) # and the elevations they are seen from
+default_cell = 128 # size in pixels that each impostor view is rendered at
 _glut_init = False
+_fbo = None # (fbo,w,h,colour,depth) that thumbnails are rendered into
+_offscreen = None # keeps the offscreen context (and OSMesa buffer) alive
+_renderer = None # software renderer, kept for its decoded textures
+_worker_mgr = None # each worker process reuses one Manager
 
-def thumb(filename_in,filename_out,w=default_w,h=default_h,pose=default_pose,background=default_background,flush=None):
-    if (flush is None) and _glut_init:
-        flush = glutSwapBuffers
-    mgr = g3d.Manager()
+def thumb(filename_in,filename_out,w=default_w,h=default_h,pose=default_pose,background=default_background,flush=None,software=False,mgr=None):
+    """renders every frame of a model and writes them as an animated GIF, or an APNG if
+    filename_out ends .png/.apng; pass the same mgr to share textures across a batch"""
+    if mgr is None:
+        mgr = g3d.Manager()
+    print "Loading G3D",filename_in
+    model = mgr.load_model(filename_in)
+    if not model.frame_count:
+        print "%s has no meshes; no thumbnail made"%filename_in
+        return
+    if software:
+        images = _frames_software(mgr,model,w,h,pose,background)
+    else:
+        images = _frames_gl(mgr,model,w,h,pose,background,flush)
+    save_animation(list(images),filename_out)
+    
+def impostor(filename_in,filename_out,yaws=default_yaws,pitches=default_pitches,frames=1,cell=default_cell,software=False,mgr=None,padding=1):
+    """renders the model from yaws headings at each of the pitches, for frames frames spread
+    through its animation, on a transparent background.  Each view is cropped to the model's
+    bounds in that frame and all are packed into one RGBA atlas; filename_out's .json sidecar
+    gives each view's rect.  Returns False, without rendering, if the sidecar is up to date
+    or the model has no meshes"""
+    settings = {"yaws":yaws,"pitches":list(pitches),"frames":frames,"cell":cell,"padding":padding,
+        "renderer":"software" if software else "gl"}
+    sidecar = os.path.splitext(filename_out)[0]+".json"
+    key = cache_key(filename_in,settings)
+    if os.path.isfile(sidecar) and os.path.isfile(filename_out):
+        try:
+            if json.load(open(sidecar)).get("key") == key:
+                return False
+        except ValueError:
+            pass
+    if mgr is None:
+        mgr = g3d.Manager()
     print "Loading G3D",filename_in
     model = mgr.load_model(filename_in)
+    frame_count = model.frame_count
+    if not frame_count:
+        print "%s has no meshes; no impostor made"%filename_in
+        return False
+    frames = sorted(set(i*frame_count//min(frames,frame_count) for i in xrange(min(frames,frame_count)))) \
+        if frames else range(frame_count)
+    views = [(frame,(pitch,360.*i/yaws,0)) for frame in frames for pitch in pitches for i in xrange(yaws)]
+    if software:
+        images = _views_software(mgr,model,cell,views)
+    else:
+        images = _views_gl(mgr,model,cell,views)
+    rects, crops = [], []
+    for (frame,pose),pixels in zip(views,images):
+        x0,y0,x1,y1 = _view_rect(model,frame,pose,cell)
+        rects.append((x0,y0,x1,y1))
+        crops.append(pixels[y0:y1,x0:x1])
+    sizes = [(x1-x0+2*padding,y1-y0+2*padding) for x0,y0,x1,y1 in rects]
+    pow2 = lambda v: 1<<int(math.ceil(math.log(max(v,1),2)))
+    width = pow2(max(math.sqrt(sum(w*h for w,h in sizes)),max(w for w,h in sizes)))
+    placed, used = g3d.shelf_pack(sizes,width)
+    W,H = used[0]
+    atlas = numpy.zeros((H,W,4),dtype=numpy.uint8)
+    entries = []
+    for (frame,pose),(x0,y0,x1,y1),crop,(page,x,y) in zip(views,rects,crops,placed):
+        x, y, w, h = x+padding, y+padding, x1-x0, y1-y0
+        atlas[y:y+h,x:x+w] = crop
+        # uv has v=0 at the bottom, as the atlas is uploaded like any other texture
+        entries.append({"frame":frame,"pitch":pose[0],"yaw":pose[1],"rect":[x,y,w,h],"offset":[x0,y0],
+            "uv":[float(x)/W,1.-float(y+h)/H,float(x+w)/W,1.-float(y)/H]})
+    Image.fromarray(atlas,"RGBA").save(filename_out)
+    json.dump({"model":filename_in,"key":key,"settings":settings,"frame_count":frame_count,
+        "size":[W,H],"views":entries},open(sidecar,"w"),indent=1,sort_keys=True)
+    print "%s: %d views packed into %dx%d"%(filename_out,len(views),W,H)
+    return True
+    
+def _view_rect(model,frame,pose,cell):
+    """the pixels, top row first, that a frame's vertices project to in a view; the
+    scaling fits the model in a sphere of radius 1, so every view fits in the cell"""
+    R = g3d_raster.rotation(pose)
+    x,y,z,s = model.scaling
+    points = [mesh.vertices[frame%len(mesh.vertices)] for mesh in model.meshes if len(mesh.vertices)]
+    if not points:
+        return 0,0,1,1
+    eye = ((numpy.concatenate(points)+(x,y,z))*s).dot(R.T)
+    lo = numpy.clip(numpy.floor((eye[:,:2].min(axis=0)+1.)*cell/2.)-1,0,cell-1).astype(int)
+    hi = numpy.clip(numpy.ceil((eye[:,:2].max(axis=0)+1.)*cell/2.)+1,lo+1,cell).astype(int)
+    return lo[0],cell-hi[1],hi[0],cell-lo[1]
+
+def save_animation(images,filename_out,delay=default_delay):
+    """encodes RGB images in-process, with one palette shared by all frames;
+    runs of identical frames become a single frame with a longer delay"""
+    w,h = images[0].size
+    strip = Image.new("RGB",(w,h*len(images)))
+    for i,img in enumerate(images):
+        strip.paste(img,(0,h*i))
+    strip = strip.convert("P",palette=Image.ADAPTIVE,colors=256)
+    frames, delays = [], []
+    for i in xrange(len(images)):
+        frame = strip.crop((0,h*i,w,h*(i+1)))
+        frame.load()
+        if frames and (_image_bytes(frame) == _image_bytes(frames[-1])):
+            delays[-1] += delay
+            continue
+        frames.append(frame)
+        delays.append(delay)
+    if os.path.splitext(filename_out)[1].lower() in (".png",".apng"):
+        _write_apng(filename_out,frames,delays,strip.getpalette())
+    else:
+        frames[0].save(filename_out,"GIF",save_all=True,append_images=frames[1:],
+            duration=delays,loop=0,optimize=False)
+            
+def _image_bytes(img):
+    return img.tobytes() if hasattr(img,"tobytes") else img.tostring()
+    
+def _write_apng(filename,frames,delays,palette):
+    def chunk(typ,data):
+        return struct.pack(">I",len(data))+typ+data+struct.pack(">I",zlib.crc32(typ+data)&0xffffffff)
+    w,h = frames[0].size
+    out = ["\x89PNG\r\n\x1a\n",
+        chunk("IHDR",struct.pack(">IIBBBBB",w,h,8,3,0,0,0)),
+        chunk("acTL",struct.pack(">II",len(frames),0)),
+        chunk("PLTE",struct.pack("%dB"%len(palette),*palette))]
+    seq = 0
+    for i,(frame,delay) in enumerate(zip(frames,delays)):
+        out.append(chunk("fcTL",struct.pack(">IIIIIHHBB",seq,w,h,0,0,delay,1000,0,0)))
+        seq += 1
+        pixels = _image_bytes(frame)
+        data = zlib.compress("".join("\0"+pixels[y*w:(y+1)*w] for y in xrange(h)),9)
+        if i == 0:
+            out.append(chunk("IDAT",data))
+        else:
+            out.append(chunk("fdAT",struct.pack(">I",seq)+data))
+            seq += 1
+    out.append(chunk("IEND",""))
+    f = open(filename,"wb")
+    f.writelines(out)
+    f.close()
+        
+def _frames_gl(mgr,model,w,h,pose,background,flush):
+    if (flush is None) and _glut_init:
+        flush = _present
+    make_fbo(w,h)
     mgr.init_gl(1)
     glClearColor(*background)
     glMatrixMode(GL_MODELVIEW)
-    glRotate(pose[0],1,0,0)
-    glRotate(pose[1],0,1,0)
-    glRotate(pose[2],0,0,1)
-    frames = []
-    out_prefix,_ = os.path.splitext(filename_out)
+    glPushMatrix()
+    try:
+        glRotate(pose[0],1,0,0)
+        glRotate(pose[1],0,1,0)
+        glRotate(pose[2],0,0,1)
+        for i in xrange(model.frame_count):
+            glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+            model.draw_gl(i)
+            pixels = glReadPixels(0,0,w,h,GL_RGB,GL_UNSIGNED_BYTE)
+            img = Image.frombuffer('RGB',(w,h),pixels,'raw','RGB',0,1)
+            yield img.transpose(Image.FLIP_TOP_BOTTOM)
+            if flush is not None: flush()
+    finally:
+        glPopMatrix()
+        
+def _views_gl(mgr,model,cell,views):
+    make_fbo(cell,cell)
+    mgr.init_gl(1)
+    glClearColor(0.,0.,0.,0.)
+    glMatrixMode(GL_MODELVIEW)
+    for frame,pose in views:
+        glPushMatrix()
+        try:
+            glRotate(pose[0],1,0,0)
+            glRotate(pose[1],0,1,0)
+            glRotate(pose[2],0,0,1)
+            glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+            model.draw_gl(frame)
+            pixels = glReadPixels(0,0,cell,cell,GL_RGBA,GL_UNSIGNED_BYTE)
+        finally:
+            glPopMatrix()
+        yield numpy.frombuffer(pixels,dtype=numpy.uint8).reshape(cell,cell,4)[::-1]
+        
+def _software_renderer(mgr,w,h):
+    global _renderer
+    if (_renderer is None) or (_renderer.mgr is not mgr) or ((_renderer.w,_renderer.h) != (w,h)):
+        _renderer = g3d_raster.Renderer(mgr,w,h)
+    return _renderer
+        
+def _frames_software(mgr,model,w,h,pose,background):
+    renderer = _software_renderer(mgr,w,h)
     for i in xrange(model.frame_count):
-        glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
-        model.draw_gl(i)
-        pixels = glReadPixels(0,0,w,h,GL_RGB,GL_UNSIGNED_BYTE)
-        png = "%s.%03d.png"%(out_prefix,len(frames))
-        img = Image.frombuffer('RGB',(w,h),pixels,'raw','RGB',0,1)
-        img = img.transpose(Image.FLIP_TOP_BOTTOM)
-        img.save(png)
-        frames.append(png)
-        if flush is not None: flush()
-    # convert to whatever
-    cmd = "convert -delay 1x10 -size %sx%s -layers Optimize %s %s"% \
-        (w,h," ".join(frames),filename_out)
-    print cmd
-    if 0 != os.system(cmd):
-        print "### conversion failed for",model.filename
-    # tidy up
-    for frame in frames:
-        os.unlink(frame)
+        yield Image.fromarray(renderer.draw(model,i,pose,background)[:,:,:3].copy())
+        
+def _views_software(mgr,model,cell,views):
+    renderer = _software_renderer(mgr,cell,cell)
+    for frame,pose in views:
+        yield renderer.draw(model,frame,pose,(0.,0.,0.,0.))
+        
+def compare(filename,w=default_w,h=default_h,pose=default_pose,mgr=None):
+    """renders the first frame of a model with OpenGL and in software, on a background no model
+    uses; returns (pixels covered by GL, pixels covered in software, fraction that differ)"""
+    if mgr is None:
+        mgr = g3d.Manager()
+    model = mgr.load_model(filename)
+    background = (1.,0.,1.,1.)
+    key = numpy.array((255,0,255))
+    gl = numpy.asarray(next(_frames_gl(mgr,model,w,h,pose,background,None)),dtype=numpy.int_)
+    sw = numpy.asarray(next(_frames_software(mgr,model,w,h,pose,background)),dtype=numpy.int_)
+    covered = lambda pixels: int((pixels != key).any(axis=2).sum())
+    return covered(gl), covered(sw), float((abs(gl-sw).max(axis=2) > 8).mean())
+        
+def thumb_job(args):
+    """thumb(*args) in software, for a multiprocessing worker; returns whether it succeeded"""
+    return _job(thumb,args)
+    
+def impostor_job(args):
+    """impostor(*args) in software, for a multiprocessing worker; returns whether it succeeded"""
+    return _job(impostor,args)
+        
+def _job(func,args):
+    global _worker_mgr
+    if _worker_mgr is None:
+        _worker_mgr = g3d.Manager()
+    try:
+        func(*args,software=True,mgr=_worker_mgr)
+        return True
+    except Exception:
+        import traceback; traceback.print_exc()
+        return False
+    finally:
+        if args[0] in _worker_mgr.models or \
+            os.path.relpath(args[0],_worker_mgr.base_folder) in _worker_mgr.models:
+            _worker_mgr.unload_model(args[0])
+        
+def make_fbo(w,h):
+    """renders into a w x h framebuffer object, so output size is independent of any window"""
+    global _fbo
+    if (_fbo is not None) and (_fbo[1:3] == (w,h)):
+        return
+    if _fbo is not None:
+        glDeleteFramebuffers(1,[_fbo[0]])
+        glDeleteRenderbuffers(2,list(_fbo[3:]))
+    fbo = glGenFramebuffers(1)
+    colour, depth = glGenRenderbuffers(2)
+    glBindRenderbuffer(GL_RENDERBUFFER,colour)
+    glRenderbufferStorage(GL_RENDERBUFFER,GL_RGBA8,w,h)
+    glBindRenderbuffer(GL_RENDERBUFFER,depth)
+    glRenderbufferStorage(GL_RENDERBUFFER,GL_DEPTH_COMPONENT24,w,h)
+    glBindRenderbuffer(GL_RENDERBUFFER,0)
+    glBindFramebuffer(GL_FRAMEBUFFER,fbo)
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER,GL_COLOR_ATTACHMENT0,GL_RENDERBUFFER,colour)
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER,GL_DEPTH_ATTACHMENT,GL_RENDERBUFFER,depth)
+    if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+        raise Exception("could not create a %dx%d framebuffer object"%(w,h))
+    glReadBuffer(GL_COLOR_ATTACHMENT0)
+    glViewport(0,0,w,h)
+    _fbo = (fbo,w,h,colour,depth)
+    
+def _present():
+    # show what was rendered into the FBO in the GLUT window
+    fbo,w,h = _fbo[:3]
+    glBindFramebuffer(GL_READ_FRAMEBUFFER,fbo)
+    glBindFramebuffer(GL_DRAW_FRAMEBUFFER,0)
+    glBlitFramebuffer(0,0,w,h,0,0,w,h,GL_COLOR_BUFFER_BIT,GL_NEAREST)
+    glutSwapBuffers()
+    glBindFramebuffer(GL_FRAMEBUFFER,fbo)
+        
+def make_offscreen(w=default_w,h=default_h):
+    """creates a GL context without any display, using the EGL or OSMesa platform
+    as selected by PYOPENGL_PLATFORM; works with Mesa's llvmpipe"""
+    global _offscreen
+    platform = os.environ.get("PYOPENGL_PLATFORM")
+    if platform == "egl":
+        from OpenGL import EGL
+        os.environ.setdefault("EGL_PLATFORM","surfaceless") # Mesa: don't look for X
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(display,ctypes.pointer(major),ctypes.pointer(minor)):
+            raise Exception("could not initialise EGL")
+        attribs = (EGL.EGLint*13)(EGL.EGL_SURFACE_TYPE,EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RED_SIZE,8,EGL.EGL_GREEN_SIZE,8,EGL.EGL_BLUE_SIZE,8,EGL.EGL_DEPTH_SIZE,24,
+            EGL.EGL_RENDERABLE_TYPE,EGL.EGL_OPENGL_BIT,EGL.EGL_NONE)
+        config, count = EGL.EGLConfig(), EGL.EGLint()
+        if not EGL.eglChooseConfig(display,attribs,ctypes.pointer(config),1,ctypes.pointer(count)) or \
+            not count.value:
+            raise Exception("no suitable EGL config")
+        # the pbuffer is just to make the context current; rendering goes to the FBO
+        surface = EGL.eglCreatePbufferSurface(display,config,
+            (EGL.EGLint*5)(EGL.EGL_WIDTH,1,EGL.EGL_HEIGHT,1,EGL.EGL_NONE))
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context = EGL.eglCreateContext(display,config,EGL.EGL_NO_CONTEXT,None)
+        if not EGL.eglMakeCurrent(display,surface,surface,context):
+            raise Exception("could not make the EGL context current")
+        _offscreen = (display,surface,context)
+    elif platform == "osmesa":
+        from OpenGL import osmesa, arrays
+        context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA,24,0,0,None)
+        buf = arrays.GLubyteArray.zeros((1,1,4))
+        if not osmesa.OSMesaMakeCurrent(context,buf,GL_UNSIGNED_BYTE,1,1):
+            raise Exception("could not make the OSMesa context current")
+        _offscreen = (context,buf)
+    else:
+        raise Exception("offscreen rendering needs PYOPENGL_PLATFORM=egl or osmesa")
+    _init_gl()
+    make_fbo(w,h)
+    
+def make_context(w=default_w,h=default_h):
+    if os.environ.get("PYOPENGL_PLATFORM") in ("egl","osmesa"):
+        try:
+            make_offscreen(w,h)
+            return
+        except Exception:
+            if "glutInit" not in globals():
+                raise # GLUT isn't available on this platform either
+            import traceback; traceback.print_exc()
+            print "offscreen rendering failed; opening a GLUT window instead"
+    make_glut(w,h)
         
 def make_glut(w=default_w,h=default_w,caption="GlestTools"):
     glutInit([])
     glutInitDisplayMode(GLUT_DOUBLE|GLUT_RGB|GLUT_DEPTH)
     glutInitWindowSize(w,h)
     glutCreateWindow(caption)
+    _init_gl()
+    make_fbo(w,h)
+    global _glut_init
+    _glut_init = True
+    
+def _init_gl():
     glEnable(GL_LIGHTING)
     glEnable(GL_LIGHT0)
     glDepthFunc(GL_LESS)
@@ -67,14 +372,12 @@ def make_glut(w=default_w,h=default_w,caption="GlestTools"):
     glLightfv(GL_LIGHT0,GL_POSITION,(1.,1.,1.,0.))
     glColorMaterial(GL_FRONT_AND_BACK,GL_AMBIENT_AND_DIFFUSE)
     glEnable(GL_COLOR_MATERIAL)
-    global _glut_init
-    _glut_init = True
 
 def main(argv):
     
     print "G3D Thumbnail Generator by William Edwards"
     
-    import getopt, os
+    import getopt
     
     if (len(argv) < 2):
         sys.exit("""usage: python g3d_thumb.py {options} [file1.g3d] ... {fileN.g3d}
@@ -83,7 +386,16 @@ options:
     -h height
     -b background-colour (rgb as 6 hexadecimal digits e.g. 00ff00 is green)
     -p pose (three rotations - x,y,z - separated by commas; default 0,130,0)
-    -o output-path (default is current folder)""")
+    -o output-path (default is current folder)
+    -a write animated PNGs rather than GIFs
+    -s render in software (numpy) instead of with OpenGL
+    -j jobs (number of worker processes for -s; default is one per core)
+    -i yaws (make a .png impostor atlas of this many headings per model instead)
+    -e pitches for -i (comma separated; default -30)
+    -n frames for -i (spread through the animation; 0 is all; default 1)
+    -c cell size in pixels for -i (default 128)
+    -t compare the software renderer with OpenGL on each model's first frame
+set PYOPENGL_PLATFORM=egl (the default without a DISPLAY) or osmesa to render headless""")
     
     mgr = g3d.Manager()
     
@@ -93,7 +405,9 @@ options:
     background = default_background
     out_path = default_out_path
     
-    opts, args = getopt.getopt(argv[1:],'w:h:p:b:o:')
+    software, jobs, ext, test = False, None, ".gif", False
+    yaws, pitches, frames, cell = None, default_pitches, 1, default_cell
+    opts, args = getopt.getopt(argv[1:],'w:h:p:b:o:sj:ai:e:n:c:t')
 
     # parse opts and override defaults
     for opt,val in opts:
@@ -108,26 +422,71 @@ options:
             background = (float(r)/255,float(g)/255,float(b)/255,1.)
         elif opt=="-o":
             out_path = val
+        elif opt=="-s":
+            software = True
+        elif opt=="-j":
+            jobs = int(val)
+        elif opt=="-a":
+            ext = ".png"
+        elif opt=="-i":
+            yaws = int(val)
+        elif opt=="-e":
+            pitches = [float(v) for v in val.split(",")]
+        elif opt=="-n":
+            frames = int(val)
+        elif opt=="-c":
+            cell = int(val)
+        elif opt=="-t":
+            test = True
         else:
             print "unsupported option:",opt,val
             sys.exit(1)
             
-    make_glut(w,h)
-            
-    def make_thumb(filename):
-        thumb(filename,os.path.join(out_path,os.path.splitext(os.path.split(filename)[1])[0]+".gif"),
-            w,h,pose,background)
+    if yaws:
+        ext = ".png"
+    def out_filename(filename):
+        return os.path.join(out_path,os.path.splitext(os.path.split(filename)[1])[0]+ext)
 
+    filenames = []
     for filename in args:
         if os.path.isfile(filename):
-            make_thumb(filename)
+            filenames.append(filename)
         else:
             for f in os.walk(filename):
                 path = f[0] 
                 for f in f[2]:
                     if os.path.splitext(f)[1] == ".g3d":
-                        filename = os.path.join(path,f)
-                        make_thumb(filename)
+                        filenames.append(os.path.join(path,f))
+                        
+    if test:
+        make_context(w,h)
+        for filename in filenames:
+            gl, sw, differ = compare(filename,w,h,pose,mgr)
+            print "%s: OpenGL covers %d pixels, software %d; %1.1f%% of pixels differ"%(filename,gl,sw,differ*100.)
+            mgr.unload_model(filename)
+        return
+    if yaws:
+        job, args = impostor_job, [(filename,out_filename(filename),yaws,pitches,frames,cell) for filename in filenames]
+    else:
+        job, args = thumb_job, [(filename,out_filename(filename),w,h,pose,background) for filename in filenames]
+    if software:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        pool.map(job,args)
+        pool.close()
+        pool.join()
+    else:
+        # one context, and one Manager so textures are uploaded once for the whole batch
+        make_context(w,h)
+        for arg in args:
+            try:
+                (impostor if yaws else thumb)(*arg,mgr=mgr)
+            except Exception:
+                import traceback; traceback.print_exc()
+            finally:
+                # an impostor that is already up to date never loads its model
+                if os.path.relpath(arg[0],mgr.base_folder) in mgr.models:
+                    mgr.unload_model(arg[0])
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -30,6 +30,7 @@ import xml.dom.minidom as minidom
 from struct import unpack
 from itertools import chain
 import zipfile, time
+import img_header
 
 # inject our logger
 class Tee:
@@ -661,6 +662,57 @@ def sum_type(mod,typ):
        typ = mod.files.typ[typ]
        print "=== %ss:"%label,len(typ),fmt_bytes(sum(f.filesize for f in typ)),"==="
             
+def owners(f):
+    """the factions (or tilesets, scenarios...) that use a file, found by following
+    the reference graph up from it"""
+    found, seen, pending = set(), set(), list(f.referenced_by)
+    while pending:
+        r = pending.pop()
+        if r in seen: continue
+        seen.add(r)
+        parts = r.modpath.split("/")
+        if "factions" in parts[:-2]:
+            found.add(parts[parts.index("factions")+1])
+        elif (parts[0] in ("tilesets","scenarios","maps")) and (len(parts) > 2):
+            found.add("/".join(parts[:2]))
+        else:
+            pending.extend(r.referenced_by)
+    if not found:
+        found.add(f.modpath.split("/")[0])
+    return found
+            
+def sum_textures(mod,max_size=img_header.max_size):
+    """the video memory textures need, per faction, from their headers alone;
+    a texture used by several factions counts towards each of them"""
+    if File.TEXTURE not in mod.files.typ: return
+    by_owner = {}
+    npot, oversized = [], []
+    total = total_mips = 0
+    for f in sorted(mod.files.typ[File.TEXTURE],lambda x,y: x.sortorder(y)):
+        if f.broken: continue
+        try:
+            header = img_header.read_header(f.path)
+        except Exception,e:
+            print "Could not read the header of",f.modpath,e
+            continue
+        vram, vram_mips = header.vram(False), header.vram()
+        total += vram
+        total_mips += vram_mips
+        if header.npot(): npot.append(f.modpath)
+        if header.oversized(max_size): oversized.append(f.modpath)
+        for owner in owners(f):
+            figures = by_owner.setdefault(owner,[0,0,0])
+            figures[0] += 1
+            figures[1] += vram
+            figures[2] += vram_mips
+    print "=== Texture memory: %s, %s with mipmaps ==="%(fmt_bytes(total),fmt_bytes(total_mips))
+    for owner,(count,vram,vram_mips) in sorted(by_owner.items()):
+        print "%s: %d textures, %s, %s with mipmaps"%(owner,count,fmt_bytes(vram),fmt_bytes(vram_mips))
+    for f in npot:
+        print "Not a power of two:",f
+    for f in oversized:
+        print "Bigger than %d:"%max_size,f
+            
 def main(argv):
     if len(argv) == 1:
         print help_modname
@@ -726,6 +778,7 @@ def main(argv):
     print "=== Included:",include_count,fmt_bytes(included),"==="
     sum_type(mod,File.MODEL)
     sum_type(mod,File.TEXTURE)
+    sum_textures(mod)
     sum_type(mod,File.PARTICLE)
     sum_type(mod,File.SOUND)
     sum_type(mod,File.UNIT)
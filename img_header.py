@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+""" reads just the headers of the images Glest uses (PNG, TGA, BMP and JPEG)
+    to find their size and channels without decoding them, and estimates
+    the video memory they take once uploaded """
+
+import os, sys, struct
+
+extensions = (".png",".tga",".bmp",".jpg",".jpeg")
+max_size = 1024 # textures bigger than this in either dimension are flagged
+
+class Header:
+    def __init__(self,filename,fmt,w,h,channels,bits):
+        self.filename = filename
+        self.fmt = fmt
+        self.w, self.h = w, h
+        self.channels = channels
+        self.bits = bits # per channel, as stored in the file
+    def texel_bytes(self):
+        # 8 bits a channel once uploaded; drivers pad RGB out to four bytes
+        return {1:1,2:2,3:4}.get(self.channels,4)
+    def vram(self,mipmaps=True):
+        return vram_bytes(self.w,self.h,self.texel_bytes(),mipmaps)
+    def npot(self):
+        return not (is_pow2(self.w) and is_pow2(self.h))
+    def oversized(self,limit=None):
+        limit = max_size if limit is None else limit
+        return max(self.w,self.h) > limit
+    def __repr__(self):
+        return "%s %s %dx%d %d channels %d bits"%(self.filename,self.fmt,self.w,self.h,self.channels,self.bits)
+
+def is_pow2(v):
+    return (v > 0) and (v & (v-1)) == 0
+
+def vram_bytes(w,h,texel_bytes,mipmaps=True):
+    total = w*h*texel_bytes
+    while mipmaps and (w > 1 or h > 1):
+        w, h = max(w//2,1), max(h//2,1)
+        total += w*h*texel_bytes
+    return total
+
+def read_header(filename):
+    """the Header of an image file; raises ValueError if it isn't a format we know"""
+    f = open(filename,"rb")
+    try:
+        start = f.read(64)
+        if start.startswith("\x89PNG\r\n\x1a\n"):
+            return _png(filename,f,start)
+        if start.startswith("BM"):
+            return _bmp(filename,f,start)
+        if start.startswith("\xff\xd8"):
+            return _jpeg(filename,f)
+        if os.path.splitext(filename)[1].lower() == ".tga": # TGA has no signature
+            return _tga(filename,start)
+        raise ValueError("%s is not a PNG, TGA, BMP or JPEG image"%filename)
+    finally:
+        f.close()
+
+def _png(filename,f,start):
+    if start[12:16] != "IHDR":
+        raise ValueError("%s has no PNG IHDR"%filename)
+    w, h, bits, colour = struct.unpack(">IIBB",start[16:26])
+    if colour == 3:
+        # palette images are expanded to RGB, or RGBA if there is a tRNS chunk
+        f.seek(33)
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                break
+            length, typ = struct.unpack(">I4s",chunk)
+            if typ == "tRNS":
+                return Header(filename,"PNG",w,h,4,8)
+            if typ == "IDAT":
+                break
+            f.seek(length+4,1)
+        return Header(filename,"PNG",w,h,3,8)
+    channels = {0:1,2:3,4:2,6:4}.get(colour)
+    if channels is None:
+        raise ValueError("%s has unknown PNG colour type %d"%(filename,colour))
+    return Header(filename,"PNG",w,h,channels,bits)
+
+def _tga(filename,start):
+    if len(start) < 18:
+        raise ValueError("%s is too short to be a TGA"%filename)
+    typ, entry_bits = ord(start[2]), ord(start[7])
+    w, h, depth, descriptor = struct.unpack("<HHBB",start[12:18])
+    if typ in (1,9): # colour-mapped
+        channels = 4 if entry_bits == 32 else 3
+    elif typ in (2,10): # true-colour
+        channels = 4 if (depth == 32) or (descriptor & 15) else 3
+    elif typ in (3,11): # greyscale
+        channels = 2 if depth == 16 else 1
+    else:
+        raise ValueError("%s is not a TGA image I understand (type %d)"%(filename,typ))
+    return Header(filename,"TGA",w,h,channels,8)
+
+def _bmp(filename,f,start):
+    size = struct.unpack("<I",start[14:18])[0]
+    if size == 12:
+        w, h, planes, bpp = struct.unpack("<HHHH",start[18:26])
+        return Header(filename,"BMP",w,h,3,8)
+    w, h, planes, bpp, compression = struct.unpack("<iiHHI",start[18:34])
+    channels = 3
+    if (bpp == 32) and (size >= 56) and (compression in (3,6)):
+        # BITFIELDS with an alpha mask
+        f.seek(14+52)
+        if struct.unpack("<I",f.read(4))[0]:
+            channels = 4
+    return Header(filename,"BMP",w,abs(h),channels,8)
+
+def _jpeg(filename,f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        while marker[1:] == "\xff": # padding
+            marker = marker[1:]+f.read(1)
+        if len(marker) < 2 or marker[0] != "\xff":
+            raise ValueError("%s has no JPEG SOF"%filename)
+        code = ord(marker[1])
+        if code in (0xd8,0x01) or (0xd0 <= code <= 0xd7):
+            continue # markers without a length
+        length = struct.unpack(">H",f.read(2))[0]
+        if (0xc0 <= code <= 0xcf) and code not in (0xc4,0xc8,0xcc):
+            bits, h, w, components = struct.unpack(">BHHB",f.read(6))
+            return Header(filename,"JPEG",w,h,1 if components == 1 else 3,bits)
+        f.seek(length-2,1)
+
+def find_images(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isfile(path):
+            filenames.append(path)
+        else:
+            for folder,dirs,files in os.walk(path):
+                filenames.extend(os.path.join(folder,f) for f in files \
+                    if os.path.splitext(f)[1].lower() in extensions)
+    return filenames
+
+def fmt_bytes(b):
+    for m in ["B","KB","MB","GB"]:
+        if b < 1024:
+            return "%1.1f %s"%(b,m)
+        b /= 1024.
+
+def main(argv):
+    import getopt, time
+    opts, args = getopt.getopt(argv[1:],"m:")
+    opts = dict(opts)
+    if not args:
+        sys.exit("""usage: python img_header.py {options} [image or folder] ...
+options:
+    -m max-size (textures bigger than this are flagged; default %d)"""%max_size)
+    limit = int(opts.get("-m",max_size))
+    start = time.time()
+    count = vram = vram_mips = 0
+    for filename in find_images(args):
+        try:
+            header = read_header(filename)
+        except Exception,e:
+            print "###",filename,e
+            continue
+        count += 1
+        vram += header.vram(False)
+        vram_mips += header.vram()
+        flags = (["NPOT"] if header.npot() else [])+(["OVERSIZED"] if header.oversized(limit) else [])
+        if flags:
+            print " ".join(flags),header
+    print "%d textures: %s VRAM, %s with mipmaps (%.2f seconds)"%(count,fmt_bytes(vram),
+        fmt_bytes(vram_mips),time.time()-start)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,39 +1,105 @@
 #!/usr/bin/env python
 
-import sys, os
+import sys, os, getopt, json
+import g3d
 from g3d_thumb import *
 
-make_glut()
-
-if len(sys.argv) < 2:
-    sys.exit("usage: [path_to_techtree] {output_suffix}")
-path = sys.argv[1]
-path = os.path.realpath(path)
-if path[-1] in ('\\','/'): path = path[:-1]
-techtree = os.path.split(path)[1]
-
-suffix = sys.argv[2]if len(sys.argv) > 2 else ""
-
-page = open("%s%s.html"%(techtree,suffix),"w")
-page.write("<html><head><title>%s</title></head><body>"%techtree)
-
-for faction in os.listdir("%s/factions/"%path):
-    if not os.path.exists("%s/factions/%s/units"%(path,faction)): continue
-    page.write("<h1>%s</h1><table>"%faction)
-    for unit in os.listdir("%s/factions/%s/units"%(path,faction)):
-        model_dir = "%s/factions/%s/units/%s/models/"%(path,faction,unit)
-        if not os.path.exists(model_dir): continue
-        page.write("<tr><th>%s"%unit)
-        for model in os.listdir(model_dir):
-            filename_in = model_dir+model
-            filename,ext = os.path.splitext(model)
-            if ext.lower() != ".g3d": continue
-            filename_out = ("%s%s_"%(faction,suffix))+os.path.split(model)[1]+".gif"
-            if not os.path.exists(filename_out) or \
-                (os.path.getmtime(filename_out) < os.path.getmtime(filename_in)):
-                # avoid recreating thumbnails from previous runs unnecessarily
-                thumb(filename_in,filename_out)
-            page.write("<td><img src=\"%s\"/>"%filename_out)
-    page.write("</table>")
-
-page.write("</body></html>")
+usage = """usage: [path_to_techtree] {output_suffix}
+options:
+    -j jobs (number of worker processes; default is one per core)
+    -g render with OpenGL (in this process) rather than in software
+    -m just regenerate the page from the manifest of a previous run"""
+
+def write_page(manifest,filename):
+    page = open(filename,"w")
+    page.write("<html><head><title>%s</title></head><body>"%manifest["techtree"])
+    for faction in manifest["factions"]:
+        page.write("<h1>%s</h1><table>"%faction["faction"])
+        for unit in faction["units"]:
+            page.write("<tr><th>%s"%unit["unit"])
+            for model in unit["models"]:
+                page.write("<td><img src=\"%s\"/>"%model["thumb"])
+        page.write("</table>")
+    page.write("</body></html>")
+    page.close()
+
+def main(argv):
+    opts, args = getopt.getopt(argv[1:],"j:gm")
+    opts = dict(opts)
+    if len(args) < 1:
+        sys.exit(usage)
+    path = os.path.realpath(args[0])
+    if path[-1] in ('\\','/'): path = path[:-1]
+    techtree = os.path.split(path)[1]
+    suffix = args[1] if len(args) > 1 else ""
+    manifest_filename = "%s%s.json"%(techtree,suffix)
+
+    if "-m" in opts:
+        write_page(json.load(open(manifest_filename)),"%s%s.html"%(techtree,suffix))
+        return
+
+    software = "-g" not in opts
+    settings = {"w":default_w,"h":default_h,"pose":default_pose,"background":default_background,
+        "renderer":"software" if software else "gl"}
+    previous = {}
+    if os.path.isfile(manifest_filename):
+        for faction in json.load(open(manifest_filename))["factions"]:
+            for unit in faction["units"]:
+                for model in unit["models"]:
+                    previous[model["thumb"]] = model["key"]
+
+    manifest = {"techtree":techtree,"settings":settings,"factions":[]}
+    jobs, entries, count = [], {}, 0
+    for faction in sorted(os.listdir("%s/factions/"%path)):
+        if not os.path.exists("%s/factions/%s/units"%(path,faction)): continue
+        units = []
+        for unit in sorted(os.listdir("%s/factions/%s/units"%(path,faction))):
+            model_dir = "%s/factions/%s/units/%s/models/"%(path,faction,unit)
+            if not os.path.exists(model_dir): continue
+            models = []
+            for model in sorted(os.listdir(model_dir)):
+                filename_in = model_dir+model
+                filename,ext = os.path.splitext(model)
+                if ext.lower() != ".g3d": continue
+                # units in a faction often have models of the same name
+                filename_out = "%s%s_%s_%s.gif"%(faction,suffix,unit,model)
+                entry = {"model":os.path.relpath(filename_in,path),"thumb":filename_out,
+                    "key":cache_key(filename_in,settings)}
+                count += 1
+                if (previous.get(filename_out) != entry["key"]) or not os.path.exists(filename_out):
+                    # avoid recreating thumbnails from previous runs unnecessarily
+                    jobs.append((filename_in,filename_out,default_w,default_h,default_pose,default_background))
+                    entries[filename_out] = entry
+                models.append(entry)
+            units.append({"unit":unit,"models":models})
+        manifest["factions"].append({"faction":faction,"units":units})
+    print "%d of %d thumbnails are up to date; rendering %d..."%(count-len(jobs),count,len(jobs))
+
+    if software:
+        import multiprocessing
+        pool = multiprocessing.Pool(int(opts["-j"]) if "-j" in opts else None)
+        results = pool.map(thumb_job,jobs)
+        pool.close()
+        pool.join()
+    else:
+        make_context()
+        mgr = g3d.Manager()
+        results = []
+        for job in jobs:
+            try:
+                thumb(*job,mgr=mgr)
+                results.append(True)
+            except Exception:
+                import traceback; traceback.print_exc()
+                results.append(False)
+            if os.path.relpath(job[0],mgr.base_folder) in mgr.models:
+                mgr.unload_model(job[0])
+    for job,ok in zip(jobs,results):
+        if not ok:
+            entries[job[1]]["key"] = None # so it is retried next time
+
+    json.dump(manifest,open(manifest_filename,"w"),indent=1,sort_keys=True)
+    write_page(manifest,"%s%s.html"%(techtree,suffix))
+
+if __name__ == "__main__":
+    main(sys.argv)